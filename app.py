@@ -4,9 +4,10 @@ Dash application (Dash [Python] <- Plotly <- React.js <- D3.js)
 Author: Akshay Balsubramani
 """
 
-import base64, io, os, time, json
-import numpy as np, scipy as sp, pandas as pd, dash, scipy.sparse
+import base64, io, os, time, json, functools
+import numpy as np, scipy as sp, pandas as pd, dash, scipy.sparse, plotly
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_core_components as dcc, dash_html_components as html
 import app_config, app_lib, building_block_divs, aknn_alg
 
@@ -16,14 +17,10 @@ import app_config, app_lib, building_block_divs, aknn_alg
 # ================== Initialize Dash app ==================
 # =========================================================
 
-# Load gene embedded coordinates.
-plot_data_df = pd.read_csv(app_config.params['plot_data_df_path'][0], sep="\t", index_col=False)
+# Datasets are loaded on first use and then served from memory (see app_lib.DatasetRegistry).
+datasets = app_lib.DatasetRegistry()
 # graph_adj = sp.sparse.load_npz(app_config.params['adj_mat_path'])
 
-raw_data = sp.sparse.load_npz(app_config.params['raw_datamat_path'][0])
-nbr_list_sorted_small = np.load(app_config.params['nbrs_path'][0])
-
-
 app = dash.Dash(__name__)
 if not app_config._DEPLOY_LOCALLY:
     app.config.update({'routes_pathname_prefix':'/aknn/', 'requests_pathname_prefix':'/aknn/'})
@@ -33,18 +30,35 @@ app.layout = building_block_divs.create_div_mainapp(
     more_colorvars=['Predicted labels', 'Adaptive k (# neighbors)', 'Adaptive k quantile']
 )
 
-def calc_clicked_idx(clickData, data_df, plot_dimension):
+# Load the default dataset(s) without holding up startup. Until they are loaded, callbacks that need them wait.
+datasets.warmup(app_config.params['warmup_datasets'])
+
+
+@server.route(app.config['routes_pathname_prefix'] + 'ready')
+def readiness():
+    """Readiness check: status 200 once the warmup datasets are loaded, 503 before then."""
+    status = datasets.status(app_config.params['warmup_datasets'])
+    return server.response_class(
+        json.dumps(status), status=(200 if status['ready'] else 503), mimetype='application/json')
+
+
+def calc_clicked_idx(clickData, assets, plot_dimension):
     dim_names = ['x', 'y']
-    dim_cols = ['hUMAP_x', 'hUMAP_y']
+    dim_cols = ('hUMAP_x', 'hUMAP_y')
     if plot_dimension == '3D':
         dim_names = ['x', 'y', 'z']
-        dim_cols = ['3D_hUMAP_x', '3D_hUMAP_y', '3D_hUMAP_z']
-    # Convert the point clicked into a float64 array and select its data
-    click_point_coords = np.array([clickData['points'][0][i] for i in dim_names]).astype(np.float64)
-    bool_mask_click = data_df.loc[:, dim_cols].eq(click_point_coords).all(axis=1)
-#     if not bool_mask_click.any():
-#         return None
-    return data_df[bool_mask_click].index[0]
+        dim_cols = ('3D_hUMAP_x', '3D_hUMAP_y', '3D_hUMAP_z')
+    click_point = clickData['points'][0]
+    # Convert the point clicked into float64 coordinates
+    click_point_coords = tuple(float(click_point[i]) for i in dim_names)
+    # Points carry their row as customdata (see app_lib.traces_scatter). The click may be on a plot of another 
+    # dataset just before it is redrawn, so the row is used only if its coordinates match.
+    clicked_idx = click_point.get('customdata')
+    if isinstance(clicked_idx, int) and (0 <= clicked_idx < assets.data_df.shape[0]):
+        if all(assets.data_df[col].values[clicked_idx] == x for (col, x) in zip(dim_cols, click_point_coords)):
+            return clicked_idx
+    # Otherwise look the point up by its coordinates. None if it is not in this dataset.
+    return assets.coord_index(dim_cols).lookup(click_point_coords)
 
 
 
@@ -68,29 +82,42 @@ def display_test(
     [Input('landscape-plot', 'clickData'), 
      Input('slider-confidence-param', 'value'), 
      Input('main-landscape-dimension', 'value'), 
-     Input('landscape-plot', 'figure')]
+     Input('sourcedata-select', 'value')]
 )
-def display_nbr_fracs(clickData, conf_param, plot_dimension, scatter_fig):
+def display_nbr_fracs(clickData, conf_param, plot_dimension, sourcedata_select):
     toret_fig = {
         'data': [], 
         'layout': building_block_divs.create_scatter_layout([])
     }
-    if not clickData or ('points' not in clickData) or (scatter_fig is None) or (len(scatter_fig['data']) <= 1):
+    if not clickData or ('points' not in clickData):
+        return toret_fig
+    assets = datasets.get_by_name(sourcedata_select)
+    clicked_idx = calc_clicked_idx(clickData, assets, plot_dimension)
+    if clicked_idx is None:
         return toret_fig
-    clicked_idx = calc_clicked_idx(clickData, plot_data_df, plot_dimension)
-    thresholds = conf_param/np.sqrt(np.arange(nbr_list_sorted_small.shape[1])+1)
-    (pred_label, adaptive_k_ndx, fracs_labels) = aknn_alg.aknn(nbr_list_sorted_small[clicked_idx,:], plot_data_df['Labels'], thresholds)
-    for i in range(len(app_config.params['label_names'])):
-        lbl_name = app_config.params['label_names'][i]
-        lbl_color = app_config.params['colorscale_discrete'][i]
-        new_trace = scatter_fig['data'][i]
-        new_trace.update({
+    explanation = assets.explainer.explain(clicked_idx, conf_param)
+    fracs_labels = explanation['fracs_labels']
+    thresholds = explanation['thresholds']
+    # Labels are colored as in the main plot (see app_lib.DatasetAssets).
+    for (i, lbl_name) in enumerate(explanation['distinct_labels']):
+        lbl_color = assets.label_colors[lbl_name]
+        toret_fig['data'].append({
+            'name': str(lbl_name), 
             'x': np.arange(len(thresholds)) + 1, 
             'y': fracs_labels[i, :], 
-            'mode': 'lines+markers'
+            'hoverinfo': 'text+name', 
+            'mode': 'lines+markers', 'type': 'scattergl', 
+            'marker': { 'size': app_config.params['marker_size'], 'color': lbl_color }, 
+            'line': { 'color': lbl_color, 'width': 3.0 }
         })
-        new_trace['line'] = { 'color': new_trace['marker']['color'], 'width': 3.0 }
-        toret_fig['data'].append(new_trace)
+    # A label is admissible where its fraction is above this line.
+    toret_fig['data'].append({
+        'name': 'Threshold (A = {:.1f})'.format(conf_param), 
+        'x': np.arange(len(thresholds)) + 1, 
+        'y': thresholds + 1.0/fracs_labels.shape[0], 
+        'mode': 'lines', 'type': 'scattergl', 
+        'line': { 'color': app_config.params['font_color'], 'width': 2.0, 'dash': 'dash' }
+    })
     return toret_fig
 
 
@@ -98,11 +125,13 @@ def display_nbr_fracs(clickData, conf_param, plot_dimension, scatter_fig):
 @app.callback(
     Output('display-datapoint', 'figure'),
     [Input('landscape-plot', 'clickData'), 
-     Input('main-landscape-dimension', 'value')]
+     Input('main-landscape-dimension', 'value'), 
+     Input('sourcedata-select', 'value')]
 )
 def display_click_image(
     clickData, 
-    plot_dimension
+    plot_dimension, 
+    sourcedata_select
 ):
     toret_fig = {
         'data': [], 
@@ -127,8 +156,11 @@ def display_click_image(
     }
     if not clickData:
         return toret_fig
-    clicked_idx = calc_clicked_idx(clickData, plot_data_df, plot_dimension)
-    image_np = raw_data[:, clicked_idx].toarray().reshape(28, 28).astype(np.float64)
+    assets = datasets.get_by_name(sourcedata_select)
+    clicked_idx = calc_clicked_idx(clickData, assets, plot_dimension)
+    if clicked_idx is None:
+        return toret_fig
+    image_np = assets.raw_data[:, clicked_idx].toarray().reshape(28, 28).astype(np.float64)
     hm_traces = [{ 
         "zmax": 255, "zmin": 0,
         'z': image_np, # 'x': hm_feat_names, 
@@ -191,27 +223,21 @@ def highlight_landscape_func(
 
 
 """
-Update the main graph panel.
+The main graph panel's figure, built once per combination of settings and cached.
 """
-@app.callback(
-    Output('landscape-plot', 'figure'), 
-    [Input('landscape-color', 'value'), 
-     Input('sourcedata-select', 'value'), 
-     Input('slider-confidence-param', 'value'), 
-     Input('slider-marker-size-factor', 'value'), 
-     Input('main-landscape-dimension', 'value')]
-)
-def update_landscape(
-    color_scheme,          # Feature(s) selected to plot as color.
+@functools.lru_cache(maxsize=app_config.params['figure_cache_size'])
+def build_landscape_figure(
     sourcedata_select, 
+    plot_dimension, 
+    color_scheme,          # Feature(s) selected to plot as color.
     confidence_param, 
     marker_size, 
-    plot_dimension
+    viewport=None          # (xmin, xmax, ymin, ymax) zoomed into, for large datasets; None if zoomed out.
 ):
-    dataset_names = app_config.params['dataset_options']
-    ndx_selected = dataset_names.index(sourcedata_select) if sourcedata_select in dataset_names else 0
-    data_df = pd.read_csv(app_config.params['plot_data_df_path'][ndx_selected], sep="\t", index_col=False)
-    nbr_list_sorted = np.load(app_config.params['nbrs_path'][ndx_selected])
+    assets = datasets.get_by_name(sourcedata_select)
+    # Columns are added below for plotting, so work on a copy of the cached frame.
+    data_df = assets.data_df.copy(deep=False)
+    nbr_list_sorted = assets.nbr_lists
 
     point_ndces_to_select = []
     absc_arr = data_df[app_config.params['display_coordinates']['x']]
@@ -235,6 +261,27 @@ def update_landscape(
             cscale = app_config.params['colorscale_discrete']
     elif (color_scheme in ['Labels']):    # color_scheme is a col ID indexing a discrete column.
         cscale = app_config.params['colorscale_discrete']
+    if not continuous_var:
+        # Each label keeps its color (assets.label_colors) whichever labels are shown, e.g. by predicted labels 
+        # or at a level of detail. Predicted labels also include '?', where AKNN abstains.
+        plot_labels = assets.plot_labels if color_scheme == 'Predicted labels' else assets.distinct_labels
+        data_df[color_scheme] = pd.Categorical(data_df[color_scheme].values, categories=plot_labels)
+        cscale = [assets.label_colors[lbl] for lbl in plot_labels]
+    # Large datasets are shown at a level of detail that depends on the viewport (see app_lib.GridIndex).
+    if use_lod(assets):
+        if plot_dimension == '3D':
+            sample_rows = np.random.RandomState(0).choice(
+                data_df.shape[0], app_config.params['lod_max_points'], replace=False)
+            data_df = data_df.iloc[np.sort(sample_rows)]
+        else:
+            rows = assets.grid_index().query(viewport) if viewport is not None else None
+            if (rows is None) or (len(rows) > app_config.params['lod_max_points']):
+                return app_lib.build_raster_scatter(
+                    data_df if rows is None else data_df.iloc[rows], color_scheme, cscale, 
+                    viewport if viewport is not None else assets.grid_index().extent, 
+                    continuous_var=continuous_var
+                )
+            data_df = data_df.iloc[rows]
     return highlight_landscape_func(
         data_df, 
         color_var=color_scheme, 
@@ -247,6 +294,117 @@ def update_landscape(
         continuous_var=continuous_var
     )
 
+
+def use_lod(assets):
+    return assets.data_df.shape[0] > app_config.params['lod_max_points']
+
+
+def landscape_figure(sourcedata_select, plot_dimension, color_scheme, confidence_param, marker_size, viewport_json):
+    # Figures colored by labels are the same for all confidence parameters, so they are cached once.
+    if color_scheme not in ['Adaptive k (# neighbors)', 'Adaptive k quantile', 'Predicted labels']:
+        confidence_param = None
+    # The viewport only matters for large datasets in 2D, and was set for the dataset shown when it was last changed.
+    viewport = None
+    if viewport_json and (plot_dimension != '3D') and use_lod(datasets.get_by_name(sourcedata_select)):
+        viewport_info = json.loads(viewport_json)
+        if (viewport_info['dataset'] == sourcedata_select) and (viewport_info['viewport'] is not None):
+            viewport = tuple(viewport_info['viewport'])
+    return build_landscape_figure(
+        sourcedata_select, plot_dimension, color_scheme, confidence_param, marker_size, viewport=viewport)
+
+
+def relayout_viewport(relayout_data, prev_viewport, extent):
+    """
+    The viewport (xmin, xmax, ymin, ymax) of the main plot after a relayout event, or None if zoomed out to the 
+    `extent` of the data. Axes not in the event keep their range in `prev_viewport` (or `extent` if None). 
+    Raises PreventUpdate for events that do not change the axis ranges.
+    """
+    viewport = list(prev_viewport if prev_viewport is not None else extent)
+    changed = False
+    for (i, axis) in enumerate(['xaxis', 'yaxis']):
+        if relayout_data.get(axis + '.autorange'):
+            viewport[2*i:2*i+2] = extent[2*i:2*i+2]
+        elif (axis + '.range[0]') in relayout_data:
+            viewport[2*i:2*i+2] = sorted([relayout_data[axis + '.range[0]'], relayout_data[axis + '.range[1]']])
+        elif (axis + '.range') in relayout_data:
+            viewport[2*i:2*i+2] = sorted(relayout_data[axis + '.range'])
+        else:
+            continue
+        changed = True
+    if not changed:
+        raise PreventUpdate
+    return None if viewport == list(extent) else tuple(viewport)
+
+
+"""
+Track the main graph panel's viewport for large datasets, whose figure depends on it (see build_landscape_figure()).
+"""
+@app.callback(
+    Output('landscape-viewport', 'children'), 
+    [Input('landscape-plot', 'relayoutData')], 
+    [State('landscape-viewport', 'children'), 
+     State('sourcedata-select', 'value'), 
+     State('main-landscape-dimension', 'value')]
+)
+def update_viewport(relayout_data, viewport_json, sourcedata_select, plot_dimension):
+    assets = datasets.get_by_name(sourcedata_select)
+    if (not relayout_data) or (plot_dimension == '3D') or (not use_lod(assets)):
+        raise PreventUpdate
+    prev_viewport = None
+    if viewport_json:
+        viewport_info = json.loads(viewport_json)
+        if viewport_info['dataset'] == sourcedata_select:
+            prev_viewport = viewport_info['viewport']
+    extent = assets.grid_index().extent
+    viewport = relayout_viewport(relayout_data, prev_viewport, [float(x) for x in extent])
+    return json.dumps({ 'dataset': sourcedata_select, 'viewport': viewport })
+
+
+"""
+Update the main graph panel. 
+
+In delta mode (app_config.params['landscape_delta_updates']), the figure is only sent when the dataset, dimension 
+or viewport changes. Changes to colors and marker size are sent as traces without coordinates, which the browser 
+applies to the points already plotted (see restyle_landscape()); for large datasets, whose figures are at most 
+app_config.params['lod_max_points'] points, the whole figure is sent this way instead.
+"""
+landscape_style_deps = [
+    ('landscape-color', 'value'), ('slider-confidence-param', 'value'), ('slider-marker-size-factor', 'value')
+]
+if app_config.params['landscape_delta_updates']:
+    landscape_inputs = []
+    landscape_state = [State(*dep) for dep in landscape_style_deps]
+else:
+    landscape_inputs = [Input(*dep) for dep in landscape_style_deps]
+    landscape_state = []
+
+@app.callback(
+    Output('landscape-plot', 'figure'), 
+    [Input('sourcedata-select', 'value'), 
+     Input('main-landscape-dimension', 'value'), 
+     Input('landscape-viewport', 'children')] + landscape_inputs, 
+    landscape_state
+)
+def update_landscape(sourcedata_select, plot_dimension, viewport_json, color_scheme, confidence_param, marker_size):
+    return landscape_figure(
+        sourcedata_select, plot_dimension, color_scheme, confidence_param, marker_size, viewport_json)
+
+
+if app_config.params['landscape_delta_updates']:
+    @app.callback(
+        Output('landscape-restyle', 'children'), 
+        [Input(*dep) for dep in landscape_style_deps], 
+        [State('sourcedata-select', 'value'), 
+         State('main-landscape-dimension', 'value'), 
+         State('landscape-viewport', 'children')]
+    )
+    def restyle_landscape(color_scheme, confidence_param, marker_size, sourcedata_select, plot_dimension, viewport_json):
+        figure = landscape_figure(
+            sourcedata_select, plot_dimension, color_scheme, confidence_param, marker_size, viewport_json)
+        if use_lod(datasets.get_by_name(sourcedata_select)):
+            return json.dumps({ 'figure': figure }, cls=plotly.utils.PlotlyJSONEncoder)
+        return json.dumps(app_lib.restyle_delta(figure), cls=plotly.utils.PlotlyJSONEncoder)
+
             
 
 # =======================================================
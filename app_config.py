@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import os, json
+
 params = {}
 
 params['title'] = "An adaptive nearest neighbor classifier"
@@ -18,6 +20,22 @@ params['bg_color'] = '#000000'
 params['plot_data_df_path'] = [params['data_pfx'] + "notMNIST/notMNIST_vizdf.csv", params['data_pfx'] + "single_cell/tabula_vizdf.csv"]
 params['raw_datamat_path'] = [params['data_pfx'] + "notMNIST/notMNIST_small_data.npz", params['data_pfx'] + "notMNIST/notMNIST_small_data.npz"]
 params['nbrs_path'] = [params['data_pfx'] + "notMNIST/notMNIST_small_nbrs_1000.npy", params['data_pfx'] + "single_cell/tabula_subset_nbrs_1000.npy"]
+# Neighbor lists truncated for confidence parameters up to params['max_confidence_param'] (see aknn_alg.RaggedNeighbors). 
+# Each is built from the dense matrix at the same index of params['nbrs_path'] when first needed.
+params['ragged_nbrs_path'] = [params['data_pfx'] + "notMNIST/notMNIST_small_nbrs_ragged", params['data_pfx'] + "single_cell/tabula_subset_nbrs_ragged"]
+params['max_confidence_param'] = 9.5
+# Memory budget for datasets loaded by the app (see app_lib.DatasetRegistry).
+params['dataset_cache_mb'] = 2048
+# Datasets loaded in the background when the app starts; the readiness check reports ready once they are loaded.
+params['warmup_datasets'] = [0]
+# Number of main scatter plot figures kept in memory, one per combination of dataset and display settings.
+params['figure_cache_size'] = 32
+# Whether changes of color and marker size are sent to the main scatter plot without the points' coordinates.
+params['landscape_delta_updates'] = True
+# Datasets with more points are plotted at a level of detail set by the zoom: as an image of each class's density 
+# (lod_raster_size pixels per side) until the view has at most this many points, which are then plotted.
+params['lod_max_points'] = 200000
+params['lod_raster_size'] = 512
 params['label_names'] = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J']
 
 
@@ -28,6 +46,17 @@ params['display_ID_var'] = 'cell_IDs'
 # params['dataset_options'] = [x.split('/')[-1].split('.')[0] for x in params['plot_data_df_path']]
 params['dataset_options'] = ["notMNIST", "Tabula Muris"]
 
+# Datasets built by build_dataset.py are registered in this file, and appended to the lists above.
+params['dataset_registry_path'] = params['data_pfx'] + "datasets.json"
+if os.path.exists(params['dataset_registry_path']):
+    with open(params['dataset_registry_path']) as f:
+        for entry in json.load(f):
+            if entry['name'] in params['dataset_options']:
+                continue
+            params['dataset_options'].append(entry['name'])
+            for key in ['plot_data_df_path', 'raw_datamat_path', 'nbrs_path', 'ragged_nbrs_path']:
+                params[key].append(entry[key])
+
 params['bg_color'] = '#000000'
 
 params['legendgroup'] = False
@@ -68,6 +97,8 @@ cmap_custom_orpu_diverging = [(0.0, '#c2b5fe'), (0.05263157894736842, '#b1a5e6')
 if 'colorscale_discrete' not in params:
     params['colorscale_discrete'] = ["#bdbdbd", "#f7ff00", "#ff8300", "#f000ff", "#001eff", "#33ccff", "#74ee15", "#33a02c", "#fb9a99", "#ff3300", "#cab2d6", 
                                      '#e6194b', '#3cb44b', '#ffe119', '#4363d8', '#f58231', '#911eb4', '#46f0f0'] # cmap_custom_discrete
+# Color of points where AKNN abstains ('?') when colored by predicted labels.
+params['abstain_color'] = '#808080'
 if 'colorscale_continuous' not in params:
     params['colorscale_continuous'] = 'Viridis'
 
@@ -1,8 +1,8 @@
 # Application-specific routines for working with (smallish matrices of) data.
 # Author: Akshay Balsubramani
 
-import base64, io, os, time, json, numpy as np, scipy as sp, pandas as pd
-import app_config, building_block_divs
+import base64, io, os, time, json, threading, collections, struct, zlib, numpy as np, scipy as sp, pandas as pd, scipy.sparse
+import app_config, building_block_divs, aknn_alg
 
 
 
@@ -22,7 +22,378 @@ def load_data(data_path):
     if 'h5ad' in data_path:
         return anndata.read_h5ad(data_path)
     else:
-        return pd.read_csv(data_path, sep="\t", index_col=False)
+        # Labels and predicted labels are read as strings, so that numeric labels match the '?' of abstentions 
+        # in type, and the label categories and colors of the plots.
+        columns = pd.read_csv(data_path, sep="\t", index_col=False, nrows=0).columns
+        label_cols = [col for col in columns if col == 'Labels' or col.startswith('Predicted labels')]
+        return pd.read_csv(data_path, sep="\t", index_col=False, converters={ col: str for col in label_cols })
+
+
+
+# =========================================================
+# ==================== Dataset registry ===================
+# =========================================================
+
+class DatasetAssets(object):
+    """
+    Everything the callbacks read for one dataset: the plotting frame, the truncated neighbor lists 
+    (memory-mapped), the raw data matrix (features x samples, memory-mapped CSC), a point explainer, and 
+    the color of each label in every plot. 
+    `on_index_built`, if given, is called with no arguments after each coordinate index is built, as nbytes() grows.
+    """
+
+    def __init__(self, ndx, on_index_built=None):
+        self.ndx = ndx
+        self.data_df = load_data(app_config.params['plot_data_df_path'][ndx])
+        self.nbr_lists = load_ragged_nbrs(ndx, self.data_df['Labels'])
+        self.raw_data = aknn_alg.load_npz_mmap(app_config.params['raw_datamat_path'][ndx], sparse_format='csc')
+        self.distinct_labels = np.unique(self.data_df['Labels'].values)
+        self.explainer = aknn_alg.PointExplainer(
+            self.nbr_lists, self.data_df['Labels'], distinct_labels=self.distinct_labels)
+        # Labels in plots include '?', where AKNN abstains. The discrete colorscale is reused if there are more labels.
+        self.plot_labels = list(self.distinct_labels) + ([] if '?' in self.distinct_labels else ['?'])
+        palette = app_config.params['colorscale_discrete']
+        self.label_colors = { lbl: palette[i % len(palette)] for (i, lbl) in enumerate(self.distinct_labels) }
+        self.label_colors.setdefault('?', app_config.params['abstain_color'])
+        self._coord_indices = {}
+        self._grid_index = None
+        self._on_index_built = on_index_built
+        self._lock = threading.Lock()
+        # Counting the frame's bytes reads every string cell, so it is done once; the indices add theirs as built.
+        self._frame_nbytes = int(self.data_df.memory_usage(deep=True).sum())
+        self._index_nbytes = 0
+
+    def coord_index(self, coord_cols):
+        """CoordinateIndex of the points in the columns `coord_cols` of the plotting frame, built on first use."""
+        with self._lock:
+            index = self._coord_indices.get(coord_cols)
+            is_new = index is None
+            if is_new:
+                index = CoordinateIndex([self.data_df[col].values for col in coord_cols])
+                self._coord_indices[coord_cols] = index
+                self._index_nbytes += index.nbytes()
+        if is_new:
+            self._notify_index_built()
+        return index
+
+    def grid_index(self):
+        """GridIndex of the points in the plot's 2D display coordinates, built on first use."""
+        with self._lock:
+            is_new = self._grid_index is None
+            if is_new:
+                display_ndces = app_config.params['display_coordinates']
+                self._grid_index = GridIndex(
+                    self.data_df[display_ndces['x']].values, self.data_df[display_ndces['y']].values)
+                self._index_nbytes += self._grid_index.nbytes()
+            index = self._grid_index
+        if is_new:
+            self._notify_index_built()
+        return index
+
+    def _notify_index_built(self):
+        # Called without this dataset's lock held, as the callback may take other locks and call nbytes().
+        if self._on_index_built is not None:
+            self._on_index_built()
+
+    def nbytes(self):
+        """
+        Bytes held in process memory: the plotting frame, the explainer's caches, and the coordinate indices. 
+        Memory-mapped arrays are left to the OS page cache and not counted.
+        """
+        with self._lock:
+            index_nbytes = self._index_nbytes
+        return self._frame_nbytes + self.explainer.cache_nbytes() + index_nbytes
+
+
+class CoordinateIndex(object):
+    """
+    Finds a point's row from its coordinates in constant expected time: rows are sorted by a hash of the bits of 
+    their coordinates, and the few rows with the hash of a queried point are checked for an exact match.
+    """
+
+    def __init__(self, coord_arrs):
+        self.coord_arrs = [np.asarray(x, dtype=np.float64) for x in coord_arrs]
+        hashes = _coord_hashes(self.coord_arrs)
+        self.order = np.argsort(hashes, kind='stable')
+        self.sorted_hashes = hashes[self.order]
+
+    def nbytes(self):
+        """Bytes of the index itself; the coordinates are those of the plotting frame."""
+        return self.order.nbytes + self.sorted_hashes.nbytes
+
+    def lookup(self, coords):
+        """Row of the first point with coordinates `coords` (a sequence of floats), or None if there is none."""
+        query_hash = _coord_hashes([np.array([x], dtype=np.float64) for x in coords])[0]
+        start = np.searchsorted(self.sorted_hashes, query_hash, side='left')
+        end = np.searchsorted(self.sorted_hashes, query_hash, side='right')
+        for row in self.order[start:end]:
+            if all(arr[row] == x for (arr, x) in zip(self.coord_arrs, coords)):
+                return int(row)
+        return None
+
+
+def _coord_hashes(coord_arrs):
+    hashes = np.zeros(len(coord_arrs[0]), dtype=np.uint64)
+    for arr in coord_arrs:
+        # Adding 0.0 maps -0.0 to 0.0, so that coordinates which compare equal hash equally.
+        hashes = (hashes ^ (arr + 0.0).view(np.uint64))*np.uint64(0x9E3779B97F4A7C15)
+    return hashes
+
+
+class DatasetRegistry(object):
+    """
+    Datasets listed in app_config, each loaded once on first use and kept in memory, up to a total of `max_mb` 
+    (as counted by DatasetAssets.nbytes(), which grows as points are explained and indexed). Beyond that, the least 
+    recently used datasets are evicted, checked whenever a dataset is loaded or one of its indices is built. 
+    The explainers' caches, bounded in size, are counted as they stand at those times. 
+    Safe to use from concurrent request threads; a dataset being loaded by one thread is waited for by others, 
+    while other datasets remain available.
+    """
+
+    def __init__(self, max_mb=app_config.params['dataset_cache_mb']):
+        self.max_bytes = max_mb*(2**20)
+        self._assets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.load_errors = {}
+
+    def get(self, ndx):
+        """DatasetAssets of the dataset at index `ndx` of app_config.params['dataset_options']."""
+        with self._lock:
+            if ndx in self._assets:
+                self._assets.move_to_end(ndx)
+                return self._assets[ndx]
+            load_lock = self._load_locks.setdefault(ndx, threading.Lock())
+        # Load outside the registry lock, so that requests for loaded datasets are not held up.
+        with load_lock:
+            with self._lock:
+                if ndx in self._assets:
+                    self._assets.move_to_end(ndx)
+                    return self._assets[ndx]
+            try:
+                assets = DatasetAssets(ndx, on_index_built=self._evict_locked)
+            except Exception as e:
+                with self._lock:
+                    self.load_errors[ndx] = repr(e)
+                raise
+            with self._lock:
+                self.load_errors.pop(ndx, None)
+                self._assets[ndx] = assets
+                self._evict()
+            return assets
+
+    def _evict(self):
+        """Evict least recently used datasets while over budget, but always keep the most recent one."""
+        total_bytes = sum(x.nbytes() for x in self._assets.values())
+        while len(self._assets) > 1 and total_bytes > self.max_bytes:
+            (_, evicted) = self._assets.popitem(last=False)
+            total_bytes -= evicted.nbytes()
+
+    def _evict_locked(self):
+        with self._lock:
+            self._evict()
+
+    def get_by_name(self, dataset_name):
+        """DatasetAssets of the dataset selected by name in the app (the first dataset if the name is unknown)."""
+        return self.get(dataset_index(dataset_name))
+
+    def warmup(self, ndces):
+        """
+        Load the datasets at indices `ndces` in a background daemon thread, so that startup does not wait for them. 
+        Returns the thread. Failures are recorded in `load_errors` rather than raised.
+        """
+        def load_all():
+            for ndx in ndces:
+                try:
+                    self.get(ndx)
+                except Exception:
+                    pass
+        thread = threading.Thread(target=load_all, name='dataset-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def status(self, ndces):
+        """
+        Readiness of the datasets at indices `ndces`: a dict with keys 'ready' (whether all are loaded), 
+        'loaded' (names of loaded datasets), and 'errors' (names of datasets that failed to load, with the error).
+        """
+        dataset_names = app_config.params['dataset_options']
+        with self._lock:
+            ready = all(ndx in self._assets for ndx in ndces)
+            loaded = [dataset_names[ndx] for ndx in self._assets]
+            errors = { dataset_names[ndx]: err for (ndx, err) in self.load_errors.items() }
+        return { 'ready': ready, 'loaded': loaded, 'errors': errors }
+
+
+def dataset_index(dataset_name):
+    dataset_names = app_config.params['dataset_options']
+    return dataset_names.index(dataset_name) if dataset_name in dataset_names else 0
+
+
+def load_ragged_nbrs(ndx_selected, labels):
+    """Truncated neighbor lists of a dataset, memory-mapped. They are built and saved on first use."""
+    ragged_path = app_config.params['ragged_nbrs_path'][ndx_selected]
+    if not os.path.exists(os.path.join(ragged_path, 'meta.json')):
+        aknn_alg.RaggedNeighbors.from_dense(
+            np.load(app_config.params['nbrs_path'][ndx_selected], mmap_mode='r'), labels, 
+            max_margin=app_config.params['max_confidence_param']
+        ).save(ragged_path)
+    return aknn_alg.RaggedNeighbors.load(ragged_path)
+
+
+# =========================================================
+# ==================== Level of detail ====================
+# =========================================================
+
+# Large datasets are plotted at a level of detail set by the zoom (see app.build_landscape_figure()): 
+# zoomed out, as an image of the density of each color class; zoomed in to a viewport with few enough points, 
+# as those points.
+
+class GridIndex(object):
+    """
+    Spatial index of 2D points. Points are bucketed into a grid of `cells_per_side`^2 cells over their extent 
+    and stored in order of their cell (row-major), so the points in a rectangle are read as one contiguous run 
+    of cells per grid row it overlaps.
+    """
+
+    def __init__(self, x, y, cells_per_side=256):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.extent = (self.x.min(), self.x.max(), self.y.min(), self.y.max())
+        self.cells_per_side = cells_per_side
+        cell_ids = self._cells(self.y, 2)*cells_per_side + self._cells(self.x, 0)
+        self.order = np.argsort(cell_ids, kind='stable')
+        self.cell_starts = np.searchsorted(cell_ids[self.order], np.arange(cells_per_side**2 + 1))
+
+    def nbytes(self):
+        """Bytes of the index itself; the coordinates are those of the plotting frame."""
+        return self.order.nbytes + self.cell_starts.nbytes
+
+    def _cells(self, vals, axis):
+        (lo, hi) = self.extent[axis:axis+2]
+        width = max((hi - lo)/self.cells_per_side, np.finfo(np.float64).tiny)
+        return np.clip(np.floor((vals - lo)/width), 0, self.cells_per_side - 1).astype(np.int64)
+
+    def query(self, viewport):
+        """Rows of the points in the rectangle `viewport` = (xmin, xmax, ymin, ymax), in increasing order."""
+        (xmin, xmax, ymin, ymax) = viewport
+        (cx_lo, cx_hi) = self._cells(np.array([xmin, xmax]), 0)
+        (cy_lo, cy_hi) = self._cells(np.array([ymin, ymax]), 2)
+        rows = np.concatenate([
+            self.order[self.cell_starts[cy*self.cells_per_side + cx_lo]:self.cell_starts[cy*self.cells_per_side + cx_hi + 1]] 
+            for cy in range(cy_lo, cy_hi + 1)
+        ])
+        (x, y) = (self.x[rows], self.y[rows])
+        return np.sort(rows[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)])
+
+
+# Stops of named Plotly colorscales used by the app.
+NAMED_COLORSCALES = {
+    'Viridis': [
+        [0, '#440154'], [0.06274509803921569, '#48186a'], [0.12549019607843137, '#472d7b'], 
+        [0.18823529411764706, '#424086'], [0.25098039215686274, '#3b528b'], [0.3137254901960784, '#33638d'], 
+        [0.3764705882352941, '#2c728e'], [0.4392156862745098, '#26828e'], [0.5019607843137255, '#21918c'], 
+        [0.5647058823529412, '#1fa088'], [0.6274509803921569, '#28ae80'], [0.6901960784313725, '#3fbc73'], 
+        [0.7529411764705882, '#5ec962'], [0.8156862745098039, '#84d44b'], [0.8784313725490196, '#addc30'], 
+        [0.9411764705882353, '#d8e219'], [1, '#fde725']
+    ]
+}
+
+
+def hex_to_rgb(hex_colors):
+    """Array of shape (len(hex_colors), 3) of the RGB values of colors given as '#rrggbb'."""
+    return np.array([[int(c[i:i+2], 16) for i in [1, 3, 5]] for c in hex_colors], dtype=np.float64)
+
+
+def colorscale_rgb(colorscale, vals):
+    """RGB values (array of shape (len(vals), 3)) of values in [0, 1] on a continuous colorscale."""
+    stops = NAMED_COLORSCALES[colorscale] if isinstance(colorscale, str) else colorscale
+    positions = np.array([pos for (pos, _) in stops], dtype=np.float64)
+    stop_rgbs = hex_to_rgb([color for (_, color) in stops])
+    return np.stack([np.interp(vals, positions, stop_rgbs[:, i]) for i in range(3)], axis=1)
+
+
+def png_data_uri(rgba):
+    """Data URI of an RGBA image (uint8 array of shape (height, width, 4)) encoded as PNG."""
+    (height, width, _) = rgba.shape
+    # Each row of pixels is preceded by its filter type, 0 (none).
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width*4)], axis=1).tobytes()
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    png = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b'')
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+
+
+def raster_scatter(x, y, color_vals, colorscale, extent, continuous_var=False, size=512):
+    """
+    Image of the points with coordinates (x, y) in the rectangle `extent` = (xmin, xmax, ymin, ymax), 
+    at `size` pixels per side. The opacity of a pixel grows with the log of its number of points. 
+    A pixel is colored by its most frequent class of a discrete color variable, with classes (the categories of 
+    `color_vals` if categorical, else its sorted values) colored in order from the list `colorscale` as in 
+    traces_scatter(); or by the mean of a continuous color variable on `colorscale`.
+    
+    Returns
+    -------
+    Data URI of the image as PNG.
+    """
+    (xmin, xmax, ymin, ymax) = extent
+    x_pix = np.clip(np.floor((x - xmin)/max(xmax - xmin, 1e-300)*size), 0, size - 1).astype(np.int64)
+    y_pix = np.clip(np.floor((y - ymin)/max(ymax - ymin, 1e-300)*size), 0, size - 1).astype(np.int64)
+    pix = (size - 1 - y_pix)*size + x_pix    # Image rows run from the top.
+    counts = np.bincount(pix, minlength=size*size)
+    if continuous_var:
+        color_vals = np.asarray(color_vals, dtype=np.float64)
+        (cmin, cmax) = (np.min(color_vals), np.percentile(color_vals, 99))
+        means = np.bincount(pix, weights=color_vals, minlength=size*size)/np.maximum(counts, 1)
+        rgb = colorscale_rgb(colorscale, (means - cmin)/max(cmax - cmin, 1e-300))
+    else:
+        classes = pd.Categorical(color_vals)
+        num_classes = len(classes.categories)
+        # Points whose value is not among the categories (code -1) only count towards the density.
+        has_class = classes.codes >= 0
+        class_counts = np.bincount(
+            classes.codes[has_class].astype(np.int64)*(size*size) + pix[has_class], minlength=num_classes*size*size)
+        rgb = hex_to_rgb(colorscale[:num_classes])[np.argmax(class_counts.reshape(num_classes, size*size), axis=0)]
+    alpha = np.where(counts > 0, 0.35 + 0.65*np.log1p(counts)/np.log1p(max(counts.max(), 1)), 0.0)
+    rgba = np.concatenate([rgb, 255*alpha[:, None]], axis=1)
+    return png_data_uri(np.round(rgba).astype(np.uint8).reshape(size, size, 4))
+
+
+def build_raster_scatter(
+    data_df, 
+    color_var, 
+    colorscale, 
+    extent, 
+    continuous_var=False
+):
+    """
+    (Data, layout) for the main graph panel showing the points of data_df as an image over the rectangle 
+    `extent` (see raster_scatter()), with one legend entry per class of a discrete color variable.
+    """
+    display_ndces = app_config.params['display_coordinates']
+    (xmin, xmax, ymin, ymax) = extent
+    image_uri = raster_scatter(
+        data_df[display_ndces['x']].values, data_df[display_ndces['y']].values, data_df[color_var].values, 
+        colorscale, extent, continuous_var=continuous_var, size=app_config.params['lod_raster_size'])
+    # Invisible points at the corners of the image, so that the axes range over it.
+    traces_list = [{
+        'x': [xmin, xmax], 'y': [ymin, ymax], 'mode': 'markers', 'marker': { 'opacity': 0 }, 
+        'hoverinfo': 'skip', 'showlegend': False, 'type': 'scattergl'
+    }]
+    if not continuous_var:
+        for (cnt, class_name) in enumerate(pd.Categorical(data_df[color_var].values).categories):
+            traces_list.append({
+                'name': str(class_name), 'x': [], 'y': [], 'mode': 'markers', 
+                'marker': { 'size': app_config.params['marker_size'], 'color': colorscale[cnt] }, 
+                'type': 'scattergl'
+            })
+    layout = layout_scatter([])
+    layout['images'] = [{
+        'source': image_uri, 'xref': 'x', 'yref': 'y', 'x': xmin, 'y': ymax, 
+        'sizex': xmax - xmin, 'sizey': ymax - ymin, 'sizing': 'stretch', 'layer': 'below'
+    }]
+    return { 'data': traces_list, 'layout': layout }
 
 
 
@@ -83,6 +454,7 @@ def traces_scatter(
                 'cmax': max_magnitude
             }, 
             'selected': style_selected, 
+            'customdata': data_df.index.values, 
             'type': 'scattergl'
         }
         if not three_dim_plot:
@@ -97,7 +469,7 @@ def traces_scatter(
         traces_list.append(trace_info)
     else:    # Categorical color scheme, one trace per color
         cnt = 0
-        for idx, val in data_df.groupby(color_var):
+        for idx, val in data_df.groupby(color_var, observed=False):
             if idx not in cumu_color_dict:
                 trace_color = colorscale[cnt]
                 cnt += 1
@@ -109,6 +481,7 @@ def traces_scatter(
                 'y': val[display_ndces['y']], 
                 'hoverinfo': 'text+name', 
                 # 'text': point_ids_this_trace, 
+                'customdata': val.index.values, 
                 'mode': 'markers', 
                 'opacity': trace_opacity, 
                 'marker': {
@@ -167,4 +540,30 @@ def build_main_scatter(
     return { 
         'data': trace_list, 
         'layout': layout_scatter(annots)
-    }
\ No newline at end of file
+    }
+
+def restyle_delta(figure):
+    """
+    The traces of a main scatter plot figure without their coordinates, for updating a plot of the same points 
+    in the browser (see assets/landscape_restyle.js), which fills in each point's coordinates by its row. 
+    
+    Returns
+    -------
+    Dict with keys 'n_points', 'three_dim_plot', and 'traces': the figure's traces, with their coordinates and 
+    customdata replaced by 'rows', the row of each point (None for a single trace of all rows in order).
+    """
+    traces = []
+    n_points = 0
+    for trace in figure['data']:
+        rows = np.asarray(trace['customdata'])
+        n_points += len(rows)
+        trace = { key: val for (key, val) in trace.items() if key not in ['x', 'y', 'z', 'customdata'] }
+        trace['rows'] = rows
+        traces.append(trace)
+    if len(traces) == 1 and np.array_equal(traces[0]['rows'], np.arange(n_points)):
+        traces[0]['rows'] = None
+    return {
+        'n_points': n_points, 
+        'three_dim_plot': any(trace['type'] == 'scatter3d' for trace in traces), 
+        'traces': traces
+    }
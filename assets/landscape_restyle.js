@@ -0,0 +1,84 @@
+// Applies partial updates of the main scatter plot, sent by app.py as JSON in the hidden 'landscape-restyle' element
+// (see restyle_delta() in app_lib.py). Each update has the plot's new traces without coordinates, and lists the rows
+// of the points in each trace; their coordinates are taken from the plot already shown. Updates of large datasets
+// are whole figures instead.
+
+(function() {
+    // Coordinates of the points in the plot, indexed by row (the customdata of each trace).
+    // null if the plot does not have exactly the rows 0, ..., numPoints - 1, e.g. if it is of another dataset.
+    function coordsByRow(gd, numPoints) {
+        var coords = { x: new Array(numPoints), y: new Array(numPoints), z: new Array(numPoints) };
+        var numFound = 0;
+        for (var t = 0; t < gd.data.length; t++) {
+            var trace = gd.data[t];
+            var rows = trace.customdata || [];
+            for (var i = 0; i < rows.length; i++) {
+                var row = rows[i];
+                if (!(row >= 0 && row < numPoints) || coords.x[row] !== undefined) {
+                    return null;
+                }
+                coords.x[row] = trace.x[i];
+                coords.y[row] = trace.y[i];
+                if (trace.z) {
+                    coords.z[row] = trace.z[i];
+                }
+                numFound++;
+            }
+        }
+        return (numFound === numPoints) ? coords : null;
+    }
+
+    function applyDelta(text) {
+        var gd = document.getElementById('landscape-plot');
+        if (gd && !gd.data) {
+            gd = gd.querySelector('.js-plotly-plot');
+        }
+        if (!text || !gd || !gd.data || gd.data.length === 0) {
+            return;
+        }
+        var delta = JSON.parse(text);
+        // Figures of large datasets, plotted at a level of detail, are sent whole.
+        if (delta.figure) {
+            Plotly.react(gd, delta.figure.data, delta.figure.layout);
+            return;
+        }
+        // The plot may not be drawn yet, or be of another dataset or dimension until the server redraws it.
+        if ((gd.data[0].type === 'scatter3d') !== delta.three_dim_plot) {
+            return;
+        }
+        var coords = coordsByRow(gd, delta.n_points);
+        if (coords === null) {
+            return;
+        }
+        var traces = delta.traces.map(function(trace) {
+            var rows = trace.rows;
+            if (rows === null) {
+                rows = [];
+                for (var row = 0; row < delta.n_points; row++) {
+                    rows.push(row);
+                }
+            }
+            delete trace.rows;
+            trace.customdata = rows;
+            trace.x = rows.map(function(row) { return coords.x[row]; });
+            trace.y = rows.map(function(row) { return coords.y[row]; });
+            if (delta.three_dim_plot) {
+                trace.z = rows.map(function(row) { return coords.z[row]; });
+            }
+            return trace;
+        });
+        Plotly.react(gd, traces, gd.layout);
+    }
+
+    // The element is rendered by Dash after this script loads, so wait for it before observing its contents.
+    var waitForElement = setInterval(function() {
+        var elem = document.getElementById('landscape-restyle');
+        if (!elem) {
+            return;
+        }
+        clearInterval(waitForElement);
+        new MutationObserver(function() {
+            applyDelta(elem.textContent);
+        }).observe(elem, { childList: true, characterData: true, subtree: true });
+    }, 100);
+})();
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Build the precomputed files the app needs for a dataset, and register it in app_config.
+
+From a raw data matrix (samples x features; dense .npy or scipy sparse .npz) and labels (.npy, or a text file
+with one label per line), builds:
+    <prefix>_nbrs_<k>.npy       Ordered nearest neighbors of each point.
+    <prefix>_nbrs_ragged/       The same lists truncated for the app's margin range (see aknn_alg.RaggedNeighbors).
+    <prefix>_data.npz           The raw data as a sparse (features x samples) matrix, as the app displays it.
+    <prefix>_vizdf.csv          2D and 3D UMAP coordinates, labels, and AKNN predictions and adaptive k at each
+                                margin on the app's slider.
+
+Stages that do not depend on each other run in parallel processes. A stage is skipped if its outputs exist and
+were built from the same inputs and settings, as recorded in <prefix>_build_manifest.json.
+
+Usage:
+    python build_dataset.py --name "My dataset" --data data.npz --labels labels.txt --out_dir /path/to/mydata
+"""
+
+import os, sys, json, hashlib, argparse, concurrent.futures
+import numpy as np, scipy.sparse, pandas as pd
+import app_config
+
+# The algorithm module lives in examples/, so that this script runs from any directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples'))
+import aknn_alg
+
+
+
+def load_matrix(path):
+    """Data matrix from a .npy file (memory-mapped) or a scipy sparse .npz file (as CSR)."""
+    if path.endswith('.npz'):
+        return scipy.sparse.load_npz(path).tocsr()
+    return np.load(path, mmap_mode='r')
+
+
+def load_labels(path):
+    if path.endswith('.npy'):
+        return np.load(path, allow_pickle=False).astype(str)
+    with open(path) as f:
+        return np.array([line.strip() for line in f if line.strip() != ''])
+
+
+def confidence_params():
+    """Margins on the app's confidence slider, for which predictions are precomputed."""
+    return np.arange(0, app_config.params['max_confidence_param'] + 0.25, 0.5)
+
+
+# =======================================================
+# ======================= Stages ========================
+# =======================================================
+
+# Each stage function takes the dict of all artifact paths and the build settings, and writes its own outputs.
+
+def stage_nbrs(paths, settings):
+    data = load_matrix(paths['data'])
+    nbr_list_sorted = aknn_alg._calc_nbrs_exact(
+        data, k=settings['k'], brute_force=True, n_jobs=settings['n_jobs'], metric=settings['metric'])
+    np.save(paths['nbrs'], nbr_list_sorted.astype(np.min_scalar_type(data.shape[0] - 1)))
+
+
+def stage_ragged_nbrs(paths, settings):
+    aknn_alg.RaggedNeighbors.from_dense(
+        np.load(paths['nbrs'], mmap_mode='r'), load_labels(paths['labels']),
+        max_margin=app_config.params['max_confidence_param']
+    ).save(paths['ragged_nbrs'])
+
+
+def stage_aknn(paths, settings):
+    """AKNN predictions at every slider margin, from one pass over the neighbors (see aknn_alg.CriticalMarginIndex)."""
+    index = aknn_alg.CriticalMarginIndex.build(np.load(paths['nbrs'], mmap_mode='r'), load_labels(paths['labels']))
+    aknn_cols = {}
+    for margin in confidence_params():
+        (pred_labels, adaptive_ks, _) = index.query(margin)
+        aknn_cols['Predicted labels (A = {:.1f})'.format(margin)] = pred_labels
+        aknn_cols['Adaptive k (A = {:.1f})'.format(margin)] = adaptive_ks
+    pd.DataFrame(aknn_cols).to_csv(paths['aknn'], sep="\t", index=False)
+
+
+def stage_embedding(paths, settings, n_components):
+    import umap
+    embedding = umap.UMAP(n_components=n_components, metric=settings['metric'], random_state=0).fit_transform(
+        load_matrix(paths['data']))
+    np.save(paths['umap{}d'.format(n_components)], embedding)
+
+
+def stage_umap2d(paths, settings):
+    stage_embedding(paths, settings, 2)
+
+
+def stage_umap3d(paths, settings):
+    stage_embedding(paths, settings, 3)
+
+
+def stage_raw_datamat(paths, settings):
+    scipy.sparse.save_npz(paths['raw_datamat'], scipy.sparse.csc_matrix(load_matrix(paths['data'])).T.tocsr())
+
+
+def stage_vizdf(paths, settings):
+    coords_2d = np.load(paths['umap2d'])
+    coords_3d = np.load(paths['umap3d'])
+    data_df = pd.DataFrame({
+        'Labels': load_labels(paths['labels']),
+        'hUMAP_x': coords_2d[:, 0], 'hUMAP_y': coords_2d[:, 1],
+        '3D_hUMAP_x': coords_3d[:, 0], '3D_hUMAP_y': coords_3d[:, 1], '3D_hUMAP_z': coords_3d[:, 2]
+    })
+    # Read as text, so that the AKNN columns are written back exactly, whatever the labels look like.
+    aknn_df = pd.read_csv(paths['aknn'], sep="\t", index_col=False, dtype=str, keep_default_na=False)
+    data_df = pd.concat([data_df, aknn_df], axis=1)
+    data_df.to_csv(paths['vizdf'], sep="\t", index=False)
+
+
+# Stage name: (function, stages it depends on, paths it writes).
+STAGES = {
+    'nbrs': (stage_nbrs, [], ['nbrs']),
+    'umap2d': (stage_umap2d, [], ['umap2d']),
+    'umap3d': (stage_umap3d, [], ['umap3d']),
+    'raw_datamat': (stage_raw_datamat, [], ['raw_datamat']),
+    'ragged_nbrs': (stage_ragged_nbrs, ['nbrs'], ['ragged_nbrs']),
+    'aknn': (stage_aknn, ['nbrs'], ['aknn']),
+    'vizdf': (stage_vizdf, ['umap2d', 'umap3d', 'aknn'], ['vizdf'])
+}
+
+
+# =======================================================
+# ===================== Build driver ====================
+# =======================================================
+
+def artifact_paths(data_path, labels_path, out_dir, prefix, k):
+    pfx = os.path.join(out_dir, prefix)
+    return {
+        'data': data_path, 'labels': labels_path,
+        'nbrs': '{}_nbrs_{}.npy'.format(pfx, k), 'ragged_nbrs': pfx + '_nbrs_ragged',
+        'umap2d': pfx + '_umap2d.npy', 'umap3d': pfx + '_umap3d.npy', 'aknn': pfx + '_aknn.tsv',
+        'raw_datamat': pfx + '_data.npz', 'vizdf': pfx + '_vizdf.csv', 'manifest': pfx + '_build_manifest.json'
+    }
+
+
+def stage_keys(paths, settings):
+    """
+    A key for each stage that changes whenever its inputs or settings do: a hash of the input data and labels,
+    the settings, and the keys of the stages it depends on.
+    """
+    labels_hash = hashlib.sha1(np.ascontiguousarray(load_labels(paths['labels'])).view(np.uint8)).hexdigest()
+    base = json.dumps({
+        'data': aknn_alg.data_fingerprint(load_matrix(paths['data'])), 'labels': labels_hash,
+        'settings': settings, 'margins': confidence_params().tolist()
+    }, sort_keys=True)
+    keys = {}
+    def key(stage):
+        if stage not in keys:
+            deps = STAGES[stage][1]
+            keys[stage] = hashlib.sha1('|'.join([base, stage] + [key(dep) for dep in deps]).encode()).hexdigest()
+        return keys[stage]
+    for stage in STAGES:
+        key(stage)
+    return keys
+
+
+def run_stage(stage, paths, settings):
+    STAGES[stage][0](paths, settings)
+    return stage
+
+
+def build_dataset(data_path, labels_path, out_dir, prefix, k=1000, metric='euclidean', n_jobs=4, force=False):
+    """
+    Run all stages that are out of date, with up to `n_jobs` stages in parallel once their dependencies are done.
+
+    Returns
+    -------
+    paths: dict
+        Paths of all artifacts.
+
+    built_stages: list
+        Stages that were run (the rest were up to date).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = artifact_paths(data_path, labels_path, out_dir, prefix, k)
+    settings = { 'k': k, 'metric': metric, 'n_jobs': 1 }
+    keys = stage_keys(paths, { 'k': k, 'metric': metric })
+    manifest = {}
+    if os.path.exists(paths['manifest']) and not force:
+        with open(paths['manifest']) as f:
+            manifest = json.load(f)
+    pending = [
+        stage for stage in STAGES
+        if manifest.get(stage) != keys[stage] or not all(os.path.exists(paths[out]) for out in STAGES[stage][2])
+    ]
+    # Stages downstream of a pending stage are pending too; their keys already differ unless outputs were deleted.
+    pending = [stage for stage in STAGES if stage in pending or any(dep in pending for dep in STAGES[stage][1])]
+    built_stages = []
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        while len(pending) + len(running) > 0:
+            for stage in list(pending):
+                if not any(dep in pending or dep in running.values() for dep in STAGES[stage][1]):
+                    pending.remove(stage)
+                    running[executor.submit(run_stage, stage, paths, settings)] = stage
+            (done, _) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                future.result()
+                built_stages.append(stage)
+                manifest[stage] = keys[stage]
+                with open(paths['manifest'], 'w') as f:
+                    json.dump(manifest, f, indent=2)
+                print('Built stage {}'.format(stage))
+    return paths, built_stages
+
+
+def register_dataset(name, paths, registry_path=app_config.params['dataset_registry_path']):
+    """Add the dataset (or update its entry) in the registry that app_config reads at startup."""
+    registry = []
+    if os.path.exists(registry_path):
+        with open(registry_path) as f:
+            registry = json.load(f)
+    entry = {
+        'name': name, 'plot_data_df_path': paths['vizdf'], 'raw_datamat_path': paths['raw_datamat'],
+        'nbrs_path': paths['nbrs'], 'ragged_nbrs_path': paths['ragged_nbrs']
+    }
+    registry = [x for x in registry if x['name'] != name] + [entry]
+    tmp_path = registry_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(registry, f, indent=2)
+    os.replace(tmp_path, registry_path)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the app's precomputed files for a dataset and register it.")
+    parser.add_argument('--name', required=True, help="Dataset name shown in the app.")
+    parser.add_argument('--data', required=True, help="Data matrix (samples x features), .npy or scipy sparse .npz.")
+    parser.add_argument('--labels', required=True, help="Labels, .npy or text with one label per line.")
+    parser.add_argument('--out_dir', required=True)
+    parser.add_argument('--prefix', default=None, help="File name prefix; defaults to the dataset name.")
+    parser.add_argument('--k', type=int, default=1000)
+    parser.add_argument('--metric', default='euclidean', choices=['euclidean', 'cosine'])
+    parser.add_argument('--n_jobs', type=int, default=4)
+    parser.add_argument('--force', action='store_true', help="Rebuild all stages.")
+    parser.add_argument('--registry', default=app_config.params['dataset_registry_path'])
+    args = parser.parse_args()
+    prefix = args.prefix if args.prefix is not None else args.name.replace(' ', '_')
+    (paths, built_stages) = build_dataset(
+        args.data, args.labels, args.out_dir, prefix, k=args.k, metric=args.metric, n_jobs=args.n_jobs, force=args.force)
+    register_dataset(args.name, paths, registry_path=args.registry)
+    print('{} stage(s) built; dataset "{}" registered in {}'.format(len(built_stages), args.name, args.registry))
@@ -171,7 +171,11 @@ def create_div_landscapes():
                 id='landscape-plot',
                 config={'displaylogo': False, 'displayModeBar': True}, 
                 style={ 'height': '100vh'}
-            )#, 
+            ), 
+            # Partial updates of the plot, applied in the browser by assets/landscape_restyle.js.
+            html.Pre(id='landscape-restyle', style={ 'display': 'none' }), 
+            # Axis ranges zoomed into, which set the level of detail of large datasets.
+            html.Pre(id='landscape-viewport', style={ 'display': 'none' })#, 
 #             html.Div(
 #                 className="row", 
 #                 children=[
@@ -286,7 +290,7 @@ def create_div_mainctrl(more_colorvars):
                 children=[
                     dcc.Slider(
                         id='slider-confidence-param',
-                        min=0, max=9.5, step=0.5, 
+                        min=0, max=app_config.params['max_confidence_param'], step=0.5, 
                         value=1.0
                     ), 
                     html.Div(
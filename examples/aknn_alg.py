@@ -8,75 +8,431 @@ https://arxiv.org/abs/1905.12717
 Author: Akshay Balsubramani
 """
 
-import numpy as np, sklearn, time
-import sklearn.metrics
+import numpy as np, scipy, sklearn, time, pickle, os, glob, shutil, threading, hashlib, functools, json, concurrent.futures, multiprocessing.shared_memory
+import scipy.sparse, sklearn.metrics
 from sklearn.neighbors import NearestNeighbors
-import pynndescent
+try:
+    import resource
+except ImportError:    # Unix only; metrics events then omit peak memory.
+    resource = None
 
 
 
+# =======================================================
+# =================== Metrics hooks ======================
+# =======================================================
+
+class MetricsSink(object):
+    """
+    Receiver of per-stage events from the AKNN pipeline. This base class ignores them, at negligible cost: 
+    events are only assembled for sinks with `enabled` set.
+    
+    Each event is a dict with at least the keys 'stage' (one of 'neighbor_search', 'label_encoding', 'prediction', 
+    'margin_computation'), 'duration' (seconds), 'rows' (number of points processed) and, where the `resource` 
+    module is available (not on Windows), 'max_rss_mb' (peak resident memory of the process so far). 
+    Prediction events also carry 'abstention_rate' and the adaptive-k distribution ('adaptive_k_mean', 
+    'adaptive_k_quantiles' at 50/90/99/100%); margin events the same summary of the margins; 
+    neighbor search events the 'backend' and its 'recall' where measured.
+    """
+    enabled = False
+
+    def emit(self, event):
+        pass
+
+
+class InMemoryMetrics(MetricsSink):
+    """Sink keeping all events in a list, with per-stage totals for export to monitoring."""
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+    def summary(self):
+        """
+        For each stage: the number of events, total 'duration' and 'rows', peak 'max_rss_mb', and the row-weighted 
+        mean of 'abstention_rate' where reported.
+        """
+        toret = {}
+        for event in self.events:
+            stage_summary = toret.setdefault(event['stage'], {'events': 0, 'duration': 0.0, 'rows': 0, 'max_rss_mb': 0.0})
+            stage_summary['events'] += 1
+            stage_summary['duration'] += event['duration']
+            stage_summary['rows'] += event['rows']
+            stage_summary['max_rss_mb'] = max(stage_summary['max_rss_mb'], event.get('max_rss_mb', 0.0))
+            if 'abstention_rate' in event:
+                stage_summary['abstained'] = stage_summary.get('abstained', 0) + event['abstention_rate']*event['rows']
+        for stage_summary in toret.values():
+            if 'abstained' in stage_summary:
+                stage_summary['abstention_rate'] = stage_summary.pop('abstained')/max(stage_summary['rows'], 1)
+        return toret
+
+    def clear(self):
+        self.events = []
+
+
+NULL_METRICS = MetricsSink()
+
+
+def _emit_stage(metrics, stage, start_time, rows, duration=None, **stats):
+    """
+    Send an event for a stage begun at time.perf_counter() value `start_time` to `metrics`, if it is enabled. 
+    If `duration` is given, it is reported instead of the time since `start_time`, which may then be None.
+    """
+    if not metrics.enabled:
+        return
+    if duration is None:
+        duration = time.perf_counter() - start_time
+    event = {'stage': stage, 'duration': duration, 'rows': int(rows)}
+    if resource is not None:
+        event['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    event.update(stats)
+    metrics.emit(event)
+
+
+def _distribution_stats(values, name):
+    """Mean and 50/90/99/100% quantiles of the finite entries of `values`, under keys prefixed by `name`."""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {}
+    return {
+        name + '_mean': float(np.mean(values)), 
+        name + '_quantiles': dict(zip(['50', '90', '99', '100'], np.percentile(values, [50, 90, 99, 100]).tolist()))
+    }
+
+
+def _emit_predictions(metrics, start_time, pred_codes, adaptive_ks, duration=None):
+    """
+    Send a prediction event with outcome stats: abstention rate, and adaptive k distribution where AKNN predicts. 
+    `duration` is as in _emit_stage().
+    """
+    if not metrics.enabled:
+        return
+    is_decided = pred_codes >= 0
+    _emit_stage(
+        metrics, 'prediction', start_time, len(pred_codes), duration=duration, abstention_rate=float(1 - np.mean(is_decided)) if len(pred_codes) > 0 else 0.0, 
+        **_distribution_stats(adaptive_ks[is_decided], 'adaptive_k'))
+
+
 def aknn_predict(
     ref_data, 
     labels, 
     margin=1.0, 
     query_data=None, 
     max_k=100, 
-    use_nndescent=False
+    use_nndescent=False, 
+    progressive=False, 
+    backend=None, 
+    target_recall=0.99, 
+    metrics=NULL_METRICS
 ):
-    # itime = time.time()
-    self_is_data = False
-    if query_data is None:
-        query_data = ref_data
-        self_is_data = True
-    
-    itime = time.time()
-    nbrs_list = _calc_nbrs_exact(ref_data, k=max_k, use_nndescent=False)
-    print('Neighbor indices computed. Time:\t {}'.format(time.time() - itime))
-    aknn_predictions = predict_nn_rule(nbrs_list, labels)
-    print('AKNN predictions made. Time:\t {}'.format(time.time() - itime))
-    return aknn_predictions
-    """
-    nbrs = sklearn.neighbors.NearestNeighbors(n_neighbors=max_k).fit(ref_data)
-    if use_nndescent:
-        index = pynndescent.NNDescent(raw_data, n_neighbors=k)
-        indices, distances = index.neighbor_graph
-    else:
-        distances, indices = nbrs.kneighbors(query_data)
-    if self_is_data:
-        indices = indices[:, 1:]
-    distinct_labels = np.unique(labels)
-    rngarr = np.arange(indices.shape[1])+1
-    query_nbrs = labels[indices]
-    fracs_labels = [np.cumsum(query_nbrs == i, axis=1)/rngarr for i in distinct_labels]
-    
-    thresholds = margin/np.sqrt(np.arange(indices.shape[1]) + 1)
-    numlabels_predicted = np.add.reduce([f > (thresholds + 1.0/len(distinct_labels)) for f in fracs_labels])
-    adaptive_k = np.argmax(numlabels_predicted > 0, axis=1)
-    pred_labels = np.zeros(fracs_labels[0].shape[0]).astype(str)
-    for i in range(fracs_labels[0].shape[0]):
-        if adaptive_k[i] == 0:
-            pred_labels[i] = '?'
-        else:
-            lst = [f[i, adaptive_k[i]] for f in fracs_labels]
-            pred_labels[i] = distinct_labels[np.argmax(lst)]
-    return np.array(pred_labels), np.array(adaptive_k)
     """
+    Fit AKNN on a labeled reference dataset and predict on query data (or on the reference data itself).
+    
+    Parameters
+    ----------
+    ref_data: array of shape (n_samples, n_features)
+        Reference dataset.
+
+    labels: array of shape (n_samples)
+        Reference dataset labels.
+    
+    margin: float
+        The confidence parameter "A" from the AKNN paper.
+    
+    query_data: array of shape (n_queries, n_features), optional
+        Points to classify. If None, classifies each reference point using its other neighbors.
+    
+    max_k: int
+        Maximum neighborhood size considered.
+    
+    backend: string, optional
+        Neighbor search backend passed to calc_nbrs(): 'tree', 'brute', 'nndescent', or 'auto'. If None, 
+        neighbors are searched with the exact tree index of AKNNClassifier. `use_nndescent` is short for 'nndescent'.
+    
+    target_recall: float
+        Recall required of approximate backends, when `backend` is 'auto'.
+    
+    progressive: bool
+        Whether to search neighbors in stages, going up to `max_k` only for points on which AKNN abstains 
+        with fewer (see AKNNClassifier.predict_progressive()). Empirical margins are then not computed (NaN).
+    
+    metrics: MetricsSink
+        Receives timing and outcome events for each stage (see MetricsSink). By default they are discarded.
+
+    Returns
+    -------
+    Same as predict_nn_rule(): (pred_labels, adaptive_ks, emp_margins).
+    """
+    if use_nndescent and backend is None:
+        backend = 'nndescent'
+    if backend is not None:
+        if progressive:
+            raise ValueError("Progressive search is only available with the default backend.")
+        (nbr_list_sorted, _) = calc_nbrs(
+            ref_data, k=max_k, backend=backend, query_data=query_data, target_recall=target_recall, metrics=metrics)
+        return predict_nn_rule(nbr_list_sorted, labels, margin=margin, metrics=metrics)
+    clf = AKNNClassifier(max_k=max_k, margin=margin, metrics=metrics).fit(ref_data, labels)
+    if progressive:
+        (pred_labels, adaptive_ks, _, _) = clf.predict_progressive(query_data)
+        return (pred_labels, adaptive_ks, np.full(len(adaptive_ks), np.nan))
+    return clf.predict_all(query_data)
 
 
-def predict_nn_rule(nbr_list_sorted, labels, margin=1.0):
+class AKNNClassifier(object):
+    """
+    AKNN classifier over a fixed labeled reference dataset.
+    
+    fit() builds the nearest neighbor index once; predictions on new query matrices are then made in batches, 
+    without revisiting the reference set. A fitted classifier can be written with save() and restored with load(), 
+    which skips rebuilding the index.
+    
+    Parameters
+    ----------
+    max_k: int
+        Maximum neighborhood size considered.
+    
+    margin: float
+        Default confidence parameter "A" from the AKNN paper.
+    
+    batch_size: int
+        Number of query points whose neighbors are searched and evaluated together.
+    
+    metrics: MetricsSink
+        Receives timing and outcome events for each stage (see MetricsSink). It is not saved with the classifier.
+    """
+
+    def __init__(self, max_k=100, margin=1.0, batch_size=4096, metrics=NULL_METRICS):
+        self.max_k = max_k
+        self.margin = margin
+        self.batch_size = batch_size
+        self.metrics = metrics
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['metrics'] = NULL_METRICS
+        return state
+
+    def fit(self, ref_data, labels):
+        """
+        Index the reference data and encode its labels.
+        
+        Parameters
+        ----------
+        ref_data: array of shape (n_samples, n_features)
+            Reference dataset.
+
+        labels: array of shape (n_samples)
+            Reference dataset labels.
+
+        Returns
+        -------
+        self
+        """
+        start_time = time.perf_counter()
+        (self.distinct_labels_, self.label_codes_) = _encode_labels(labels)
+        _emit_stage(self.metrics, 'label_encoding', start_time, len(self.label_codes_))
+        start_time = time.perf_counter()
+        self.ref_data_ = ref_data if scipy.sparse.issparse(ref_data) else np.asarray(ref_data)
+        self.nn_index_ = NearestNeighbors(n_neighbors=self.max_k + 1).fit(self.ref_data_)
+        _emit_stage(self.metrics, 'neighbor_search', start_time, 0, backend='tree', step='index')
+        return self
+
+    def kneighbors(self, query_data=None):
+        """
+        Indices of the `max_k` nearest reference points of each query point, in order. 
+        If `query_data` is None, these are the neighbors of each reference point, excluding itself. 
+        Ties in distance are broken by lower index.
+        """
+        start_time = time.perf_counter()
+        if query_data is None:
+            nbr_list_sorted = self._search(
+                self.ref_data_, self.max_k, self_ndces=np.arange(self.ref_data_.shape[0]))
+        else:
+            nbr_list_sorted = self._search(query_data, self.max_k)
+        _emit_stage(self.metrics, 'neighbor_search', start_time, len(nbr_list_sorted), backend='tree', k=self.max_k)
+        return nbr_list_sorted
+
+    def predict_all(self, query_data=None, margin=None, compute_margins=True):
+        """
+        AKNN label predictions, adaptive neighborhood sizes and empirical margins for query points.
+        
+        Parameters
+        ----------
+        query_data: array of shape (n_queries, n_features), optional
+            Points to classify. If None, classifies each reference point using its other neighbors.
+        
+        margin: float, optional
+            Confidence parameter; defaults to the one given at construction.
+        
+        compute_margins: bool
+            Whether to compute empirical margins. See predict_nn_rule().
+
+        Returns
+        -------
+        Same as predict_nn_rule(): (pred_labels, adaptive_ks, emp_margins).
+        """
+        margin = self.margin if margin is None else margin
+        if query_data is None:
+            (pred_codes, adaptive_ks, emp_margins) = _predict_codes(
+                self.kneighbors(), self.label_codes_, len(self.distinct_labels_), margin, 
+                compute_margins=compute_margins, metrics=self.metrics)
+            return _decode_labels(pred_codes, self.distinct_labels_), adaptive_ks, emp_margins
+        num_queries = query_data.shape[0]
+        pred_codes = np.zeros(num_queries, dtype=np.int64)
+        adaptive_ks = np.zeros(num_queries, dtype=np.int64)
+        emp_margins = np.full(num_queries, np.nan)
+        for start in range(0, num_queries, self.batch_size):
+            batch = slice(start, start + self.batch_size)
+            (pred_codes[batch], adaptive_ks[batch], emp_margins[batch]) = _predict_codes(
+                self.kneighbors(query_data[batch]), self.label_codes_, len(self.distinct_labels_), margin, 
+                compute_margins=compute_margins, metrics=self.metrics)
+        return _decode_labels(pred_codes, self.distinct_labels_), adaptive_ks, emp_margins
+
+    def predict_progressive(self, query_data=None, margin=None, initial_k=16, growth_factor=4):
+        """
+        AKNN predictions with staged neighbor retrieval: neighbors are first searched with a small k for all 
+        query points, and only the points on which AKNN still abstains are searched again, with k growing 
+        geometrically up to `max_k`. Predictions and adaptive neighborhood sizes are identical to those of 
+        predict_all() up to ties in distance (between neighbors at the end of a stage's lists and beyond them), 
+        but most points need only a few neighbors searched and stored.
+        
+        Parameters
+        ----------
+        query_data: array of shape (n_queries, n_features), optional
+            Points to classify. If None, classifies each reference point using its other neighbors.
+        
+        margin: float, optional
+            Confidence parameter; defaults to the one given at construction.
+        
+        initial_k: int
+            Number of neighbors searched for every point in the first stage.
+        
+        growth_factor: int
+            Factor by which k grows between stages.
+
+        Returns
+        -------
+        pred_labels, adaptive_ks: arrays of shape (n_queries)
+            As in predict_all().
+        
+        nbr_indptr: array of shape (n_queries + 1)
+        nbr_indices: array of shape (nbr_indptr[-1])
+            Neighbor lists truncated at each point's adaptive neighborhood size (at `max_k` where AKNN abstains), 
+            in CSR layout: those of point i are nbr_indices[nbr_indptr[i]:nbr_indptr[i+1]].
+        """
+        start_time = time.perf_counter()
+        margin = self.margin if margin is None else margin
+        num_queries = self.label_codes_.shape[0] if query_data is None else query_data.shape[0]
+        pred_codes = np.full(num_queries, -1, dtype=np.int64)
+        adaptive_ks = np.full(num_queries, self.max_k + 1, dtype=np.int64)
+        nbr_lengths = np.zeros(num_queries, dtype=np.int64)
+        stored_nbrs = []
+        active_rows = np.arange(num_queries)
+        k = min(initial_k, self.max_k)
+        while len(active_rows) > 0:
+            nbr_list_sorted = self._kneighbors_rows(query_data, active_rows, k)
+            (stage_codes, stage_ks, _) = _predict_codes(
+                nbr_list_sorted, self.label_codes_, len(self.distinct_labels_), margin, compute_margins=False)
+            # Abstaining with fewer than max_k neighbors only means the search must go further.
+            is_final = (stage_codes >= 0) | (k == self.max_k)
+            final_rows = active_rows[is_final]
+            pred_codes[final_rows] = stage_codes[is_final]
+            adaptive_ks[final_rows] = np.where(stage_codes[is_final] >= 0, stage_ks[is_final], self.max_k + 1)
+            nbr_lengths[final_rows] = np.minimum(stage_ks[is_final], k)
+            is_stored = np.arange(k) < nbr_lengths[final_rows][:, None]
+            stored_nbrs.append((final_rows, nbr_list_sorted[is_final][is_stored]))
+            active_rows = active_rows[~is_final]
+            k = min(k*growth_factor, self.max_k)
+        nbr_indptr = np.zeros(num_queries + 1, dtype=np.int64)
+        np.cumsum(nbr_lengths, out=nbr_indptr[1:])
+        nbr_indices = np.zeros(nbr_indptr[-1], dtype=np.int64)
+        for (final_rows, nbrs) in stored_nbrs:
+            # Positions of each stored row's entries in the CSR layout, in row order.
+            row_lengths = nbr_lengths[final_rows]
+            offsets = np.arange(len(nbrs)) - np.repeat(np.cumsum(row_lengths) - row_lengths, row_lengths)
+            nbr_indices[np.repeat(nbr_indptr[final_rows], row_lengths) + offsets] = nbrs
+        # One event for all stages, which includes their neighbor searches (also reported separately).
+        _emit_predictions(self.metrics, start_time, pred_codes, adaptive_ks)
+        return _decode_labels(pred_codes, self.distinct_labels_), adaptive_ks, nbr_indptr, nbr_indices
+
+    def _kneighbors_rows(self, query_data, row_ndces, k):
+        """
+        Indices of the `k` nearest reference points of the query points `row_ndces`, in order. If `query_data` 
+        is None, the query points are reference points, and each is excluded from its own list.
+        """
+        start_time = time.perf_counter()
+        if query_data is not None:
+            nbr_list_sorted = self._search(query_data[row_ndces], k)
+        else:
+            nbr_list_sorted = self._search(self.ref_data_[row_ndces], k, self_ndces=row_ndces)
+        _emit_stage(self.metrics, 'neighbor_search', start_time, len(row_ndces), backend='tree', k=k)
+        return nbr_list_sorted
+
+    def _search(self, query_points, k, self_ndces=None):
+        """
+        Indices of the `k` nearest reference points of `query_points`, nearest first, with ties in distance 
+        broken by lower index as in _calc_nbrs_blocked(). If `self_ndces` is given, query point i is reference point 
+        self_ndces[i], which is excluded from its own list.
+        """
+        num_searched = k if self_ndces is None else k + 1
+        (dists, nbr_list_sorted) = self.nn_index_.kneighbors(query_points, n_neighbors=num_searched)
+        order = np.argsort(nbr_list_sorted, axis=1)
+        order = np.take_along_axis(order, np.argsort(np.take_along_axis(dists, order, axis=1), axis=1, kind='stable'), axis=1)
+        nbr_list_sorted = np.take_along_axis(nbr_list_sorted, order, axis=1)
+        return nbr_list_sorted if self_ndces is None else _drop_self_nbrs(nbr_list_sorted, self_ndces)
+
+    def predict(self, query_data=None, margin=None):
+        """AKNN label predictions for query points ('?' where AKNN abstains). See predict_all()."""
+        return self.predict_all(query_data, margin=margin, compute_margins=False)[0]
+
+    def save(self, path):
+        """Write the fitted classifier, including its neighbor index, to `path`."""
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """Read a classifier written by save()."""
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def predict_nn_rule(
+    nbr_list_sorted, labels, margin=1.0, chunk_size=256, compute_margins=True, n_jobs=1, metrics=NULL_METRICS
+):
     """
     Given matrix of ordered nearest neighbors for each point, returns AKNN's label predictions and adaptive neighborhood sizes.
     
     Parameters
     ----------
-    nbr_list_sorted: array of shape (n_samples, n_neighbors)
-        Indices of the `n_neighbors` nearest neighbors in the dataset, for each data point.
+    nbr_list_sorted: array of shape (n_samples, n_neighbors), or RaggedNeighbors
+        Indices of the `n_neighbors` nearest neighbors in the dataset, for each data point. 
+        Truncated lists (RaggedNeighbors) can be evaluated at margins up to their `max_margin`, 
+        with `compute_margins` False.
 
     labels: array of shape (n_samples)
         Dataset labels.
     
     margin: float
         The confidence parameter "A" from the AKNN paper.
+    
+    chunk_size: int
+        Number of rows of `nbr_list_sorted` evaluated together. Peak memory is O(chunk_size * n_neighbors * n_labels).
+    
+    compute_margins: bool
+        Whether to compute empirical margins, which requires reading all `n_neighbors` neighbors of every point. 
+        If False, each point's neighbors are only read until it becomes admissible, which is much faster 
+        when adaptive neighborhoods are small.
+    
+    n_jobs: int
+        Number of worker processes over which the rows of `nbr_list_sorted` are split (see _predict_codes_parallel()).
+    
+    metrics: MetricsSink
+        Receives timing and outcome events for label encoding, prediction and margin computation (see MetricsSink).
 
     Returns
     -------
@@ -87,21 +443,472 @@ def predict_nn_rule(nbr_list_sorted, labels, margin=1.0):
         AKNN neighborhood sizes on dataset.
     
     emp_margins: array of shape (n_samples)
-        Empirically calculated "advantage" of each point.
+        Empirically calculated "advantage" of each point (NaN if `compute_margins` is False).
     """
-    pred_labels = []
-    adaptive_ks = []
-    thresholds = margin/np.sqrt(np.arange(nbr_list_sorted.shape[1])+1)
-    distinct_labels = np.unique(labels)
-    for i in range(nbr_list_sorted.shape[0]):
-        (pred_label, adaptive_k_ndx, _, emp_margin) = aknn(nbr_list_sorted[i,:], labels, thresholds)
-        pred_labels.append(pred_label)
-        adaptive_ks.append(adaptive_k_ndx + 1)
-        emp_margins.append(emp_margin)
-    return np.array(pred_labels), np.array(adaptive_ks), np.array(emp_margins)
+    start_time = time.perf_counter()
+    (distinct_labels, label_codes) = _encode_labels(labels)
+    _emit_stage(metrics, 'label_encoding', start_time, len(label_codes))
+    predict_fn = _predict_codes if n_jobs <= 1 else functools.partial(_predict_codes_parallel, n_jobs=n_jobs)
+    (pred_codes, adaptive_ks, emp_margins) = predict_fn(
+        nbr_list_sorted, label_codes, len(distinct_labels), margin, chunk_size=chunk_size, 
+        compute_margins=compute_margins, metrics=metrics)
+    return _decode_labels(pred_codes, distinct_labels), adaptive_ks, emp_margins
 
 
-def aknn(nbrs_arr, labels, thresholds, distinct_labels=['A','B','C','D','E','F','G','H','I','J']):
+def _encode_labels(labels):
+    """
+    Sorted distinct labels, and the code (index into them) of each label, in the smallest sufficient integer dtype.
+    """
+    distinct_labels, label_codes = np.unique(np.asarray(labels), return_inverse=True)
+    return distinct_labels, label_codes.astype(np.min_scalar_type(len(distinct_labels)))
+
+
+def _encode_with(values, distinct_labels):
+    """
+    Index of each of `values` in the array `distinct_labels` (which need not be sorted), or -1 if absent.
+    """
+    sorter = np.argsort(distinct_labels, kind='stable')
+    positions = np.minimum(np.searchsorted(distinct_labels, values, sorter=sorter), len(distinct_labels) - 1)
+    codes = sorter[positions]
+    return np.where(distinct_labels[codes] == values, codes, -1)
+
+
+def _decode_labels(pred_codes, distinct_labels):
+    """
+    String labels for predicted label codes, with '?' where AKNN abstains (code -1).
+    """
+    return np.where(pred_codes >= 0, distinct_labels.astype(str)[pred_codes], '?')
+
+
+def _predict_codes(
+    nbr_list_sorted, label_codes, n_labels, margin, chunk_size=256, compute_margins=True, metrics=NULL_METRICS
+):
+    """
+    predict_nn_rule() on integer label codes. Returns the predicted codes (-1 where AKNN abstains) 
+    instead of labels, along with adaptive neighborhood sizes and empirical margins.
+    
+    If `compute_margins` is False, each point's neighbors are only read up to its adaptive neighborhood size 
+    (see _aknn_batch_early_exit()), and the returned margins are NaN.
+    
+    Sends a prediction event to `metrics`, and a margin computation event if `compute_margins` is True. 
+    The margin computation time, which shares the running label counts with prediction, is excluded from the former.
+    """
+    start_time = time.perf_counter()
+    _check_truncation(nbr_list_sorted, margin, compute_margins)
+    num_points, num_nbrs = nbr_list_sorted.shape
+    thresholds = margin/np.sqrt(np.arange(num_nbrs)+1)
+    admissible_counts = _admissible_counts(thresholds, n_labels)
+    if compute_margins:
+        margin_table = _emp_margin_table(num_nbrs, n_labels)
+    pred_codes = np.zeros(num_points, dtype=np.int64)
+    adaptive_ks = np.zeros(num_points, dtype=np.int64)
+    emp_margins = np.full(num_points, np.nan)
+    stage_times = {'margin_computation': 0.0}
+    for start in range(0, num_points, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        if compute_margins:
+            nbr_codes = label_codes[np.asarray(nbr_list_sorted[chunk])]
+            (pred_codes[chunk], first_admissible_ndces, emp_margins[chunk]) = _aknn_batch(
+                nbr_codes, n_labels, admissible_counts, margin_table, stage_times=stage_times)
+        else:
+            (pred_codes[chunk], first_admissible_ndces) = _aknn_batch_early_exit(
+                nbr_list_sorted[chunk], label_codes, n_labels, admissible_counts)
+        adaptive_ks[chunk] = first_admissible_ndces + 1
+    margin_duration = stage_times['margin_computation']
+    _emit_predictions(
+        metrics, start_time, pred_codes, adaptive_ks, duration=time.perf_counter() - start_time - margin_duration)
+    if compute_margins:
+        _emit_stage(
+            metrics, 'margin_computation', None, num_points, duration=margin_duration, 
+            **_distribution_stats(emp_margins, 'emp_margin'))
+    return pred_codes, adaptive_ks, emp_margins
+
+
+def _check_truncation(nbr_list_sorted, margin, compute_margins):
+    """Raise ValueError if truncated neighbor lists (RaggedNeighbors) cannot give exact results for these settings."""
+    if isinstance(nbr_list_sorted, RaggedNeighbors):
+        nbr_list_sorted.check_margin(margin)
+        if compute_margins:
+            raise ValueError("Empirical margins need full neighbor lists, which RaggedNeighbors does not store.")
+
+
+def _predict_codes_parallel(
+    nbr_list_sorted, label_codes, n_labels, margin, n_jobs=2, chunk_size=256, compute_margins=True, shard_size=None, 
+    metrics=NULL_METRICS
+):
+    """
+    _predict_codes() with the rows of `nbr_list_sorted` split into contiguous shards, evaluated by a pool 
+    of `n_jobs` worker processes. Results are gathered in row order, and are identical to _predict_codes().
+    
+    Workers do not receive pickled copies of the inputs. A memory-mapped neighbor matrix (e.g. from np.load 
+    with mmap_mode='r') is re-mapped by each worker from its file; other arrays are copied once into 
+    shared memory, which the workers attach to for the lifetime of the pool.
+    
+    A single prediction event is sent to `metrics`, covering the whole pool (including any margin computation).
+    """
+    start_time = time.perf_counter()
+    _check_truncation(nbr_list_sorted, margin, compute_margins)
+    num_points = nbr_list_sorted.shape[0]
+    if shard_size is None:
+        # A few shards per worker, to balance load when adaptive neighborhood sizes vary across the data.
+        shard_size = max(chunk_size, -(-num_points//(4*n_jobs)))
+    shared_blocks = []
+    try:
+        arr_specs = []
+        for arr in (nbr_list_sorted, label_codes):
+            (arr_spec, shms) = _share_array(arr)
+            arr_specs.append(arr_spec)
+            shared_blocks.extend(shms)
+        shard_starts = range(0, num_points, shard_size)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_prediction_worker, initargs=(arr_specs,)
+        ) as executor:
+            shard_results = list(executor.map(
+                _predict_shard, shard_starts, [shard_size]*len(shard_starts), [n_labels]*len(shard_starts), 
+                [margin]*len(shard_starts), [chunk_size]*len(shard_starts), [compute_margins]*len(shard_starts)))
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+    if len(shard_results) == 0:
+        return _predict_codes(nbr_list_sorted, label_codes, n_labels, margin, chunk_size, compute_margins, metrics=metrics)
+    (pred_codes, adaptive_ks, emp_margins) = [np.concatenate(results) for results in zip(*shard_results)]
+    _emit_predictions(metrics, start_time, pred_codes, adaptive_ks)
+    return pred_codes, adaptive_ks, emp_margins
+
+
+# Arrays attached by each prediction worker process, set by _init_prediction_worker().
+_worker_arrays = None
+
+
+def _init_prediction_worker(arr_specs):
+    global _worker_arrays
+    _worker_arrays = [_attach_array(arr_spec) for arr_spec in arr_specs]
+
+
+def _predict_shard(start, shard_size, n_labels, margin, chunk_size, compute_margins):
+    (nbr_list_sorted, label_codes) = [arr for (arr, _) in _worker_arrays]
+    if isinstance(nbr_list_sorted, RaggedNeighbors):
+        shard_nbrs = nbr_list_sorted.row_range(start, start + shard_size)
+    else:
+        shard_nbrs = nbr_list_sorted[start:start + shard_size]
+    return _predict_codes(
+        shard_nbrs, label_codes, n_labels, margin, 
+        chunk_size=chunk_size, compute_margins=compute_margins)
+
+
+def _share_array(arr):
+    """
+    Picklable description of `arr` (an array or RaggedNeighbors) from which other processes can map its data 
+    without copying, and the SharedMemory blocks created to hold the data (none for arrays that are already 
+    memory-mapped from a file). The caller must close and unlink the blocks when done.
+    """
+    if isinstance(arr, RaggedNeighbors):
+        (indptr_spec, indptr_shms) = _share_array(arr.indptr)
+        (indices_spec, indices_shms) = _share_array(arr.indices)
+        return ('ragged', indptr_spec, indices_spec, arr.num_nbrs, arr.max_margin), indptr_shms + indices_shms
+    mmap_root = arr
+    while isinstance(mmap_root, np.memmap) and isinstance(mmap_root.base, np.ndarray):
+        mmap_root = mmap_root.base
+    if isinstance(mmap_root, np.memmap) and mmap_root.filename is not None:
+        byte_offset = mmap_root.offset + (arr.__array_interface__['data'][0] - mmap_root.__array_interface__['data'][0])
+        return ('file', mmap_root.filename, byte_offset, arr.shape, arr.strides, arr.dtype.str), []
+    arr = np.ascontiguousarray(arr)
+    shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return ('shm', shm.name, 0, arr.shape, arr.strides, arr.dtype.str), [shm]
+
+
+def _attach_array(arr_spec):
+    """
+    Read-only view of an array (or RaggedNeighbors) shared with _share_array(), and the object(s) owning its buffers, 
+    which must be kept alive as long as the view is used.
+    """
+    if arr_spec[0] == 'ragged':
+        (_, indptr_spec, indices_spec, num_nbrs, max_margin) = arr_spec
+        (indptr, indptr_owner) = _attach_array(indptr_spec)
+        (indices, indices_owner) = _attach_array(indices_spec)
+        return RaggedNeighbors(indptr, indices, num_nbrs, max_margin), (indptr_owner, indices_owner)
+    (kind, name, byte_offset, shape, strides, dtype) = arr_spec
+    if kind == 'file':
+        owner = np.memmap(name, dtype=np.uint8, mode='r')
+        buf = owner
+    else:
+        owner = multiprocessing.shared_memory.SharedMemory(name=name)
+        buf = owner.buf
+    arr = np.ndarray(shape, dtype=dtype, buffer=buf, offset=byte_offset, strides=strides)
+    arr.flags.writeable = False
+    return arr, owner
+
+
+def _aknn_batch_early_exit(nbr_list_sorted, label_codes, n_labels, admissible_counts, first_stage_size=16):
+    """
+    Apply AKNN rule to a block of query points, reading each point's neighbors only until it becomes admissible.
+    
+    Neighbors are consumed in stages of geometrically increasing size (first_stage_size, then growing 4-fold). 
+    After each stage, points that have become admissible are finalized, and only the remaining points 
+    go on to the next, longer prefix of their neighbor lists. The cost thus scales with the adaptive 
+    neighborhood sizes actually needed rather than with n_neighbors. Empirical margins are not computed.
+
+    Returns
+    -------
+    pred_codes, first_admissible_ndces: arrays of shape (n_rows)
+        As in _aknn_batch().
+    """
+    num_rows, num_nbrs = nbr_list_sorted.shape
+    pred_codes = np.full(num_rows, -1, dtype=np.int64)
+    first_admissible_ndces = np.full(num_rows, num_nbrs, dtype=np.int64)
+    active_rows = np.arange(num_rows)
+    stage_end = min(first_stage_size, num_nbrs)
+    while len(active_rows) > 0:
+        nbr_codes = label_codes[np.asarray(nbr_list_sorted[active_rows, :stage_end])]
+        (stage_codes, stage_ndces, _) = _aknn_batch(nbr_codes, n_labels, admissible_counts[:stage_end])
+        is_decided = stage_codes >= 0
+        pred_codes[active_rows[is_decided]] = stage_codes[is_decided]
+        first_admissible_ndces[active_rows[is_decided]] = stage_ndces[is_decided]
+        if stage_end == num_nbrs:
+            break
+        active_rows = active_rows[~is_decided]
+        stage_end = min(4*stage_end, num_nbrs)
+    return (pred_codes, first_admissible_ndces)
+
+
+def _aknn_batch(nbr_codes, n_labels, admissible_counts, margin_table=None, stage_times=None):
+    """
+    Apply AKNN rule to a block of query points at once, given the label codes of their nearest neighbors.
+    
+    Parameters
+    ----------
+    nbr_codes: array of shape (n_rows, n_neighbors)
+        Integer label codes (in [0, n_labels)) of the ordered nearest neighbors of each query point.
+
+    n_labels: int
+        Number of distinct labels.
+    
+    admissible_counts: array of shape (n_neighbors)
+        Bias thresholds at different neighborhood sizes, as label counts. See _admissible_counts().
+    
+    margin_table: array of shape (n_neighbors, n_neighbors+1), optional
+        Lookup table of empirical margin terms (see _emp_margin_table()). If None, margins are not computed.
+    
+    stage_times: dict, optional
+        If given, the seconds spent computing margins are added to its entry 'margin_computation'.
+
+    Returns
+    -------
+    pred_codes: array of shape (n_rows)
+        Label code predicted by AKNN, or -1 where it abstains.
+
+    first_admissible_ndces: array of shape (n_rows)
+        n-1, where AKNN chooses neighborhood size n (n_neighbors where it abstains).
+    
+    emp_margins: array of shape (n_rows)
+        Empirical "advantage" of each point (NaN if `margin_table` is None).
+    """
+    num_rows, num_nbrs = nbr_codes.shape
+    (max_counts, min_counts, label_stats) = _label_count_extremes(
+        nbr_codes, n_labels, with_min=(margin_table is not None))
+    admissible = max_counts >= admissible_counts[:, None]
+    is_decided = admissible.any(axis=0)
+    first_admissible_ndces = np.where(is_decided, np.argmax(admissible, axis=0), num_nbrs)
+    # Break any ties between labels at stopping radius, by taking the most biased label (lowest code first).
+    stop_codes = _top_labels_at(label_stats, np.minimum(first_admissible_ndces, num_nbrs - 1), np.arange(num_rows))
+    pred_codes = np.where(is_decided, stop_codes, -1)
+    if margin_table is None:
+        return (pred_codes, first_admissible_ndces, np.full(num_rows, np.nan))
+    start_time = time.perf_counter()
+    # The squared bias at each neighborhood size is largest for one of the two extreme labels.
+    table_offsets = (np.arange(num_nbrs)*(num_nbrs + 1))[:, None]
+    emp_margins = np.maximum(
+        margin_table.take(table_offsets + max_counts).max(axis=0), 
+        margin_table.take(table_offsets + min_counts).max(axis=0)
+    )
+    if stage_times is not None:
+        stage_times['margin_computation'] += time.perf_counter() - start_time
+    return (pred_codes, first_admissible_ndces, emp_margins)
+
+
+# Above this many labels, running label counts are kept sparsely per point rather than for every label.
+_MAX_DENSE_COUNT_LABELS = 24
+
+
+def _label_count_extremes(nbr_codes, n_labels, with_min=True):
+    """
+    Counts of the most and least frequent labels among the first j+1 neighbors of each point.
+    
+    Parameters
+    ----------
+    nbr_codes: array of shape (n_rows, n_neighbors)
+        Integer label codes of the ordered nearest neighbors of each query point.
+
+    n_labels: int
+        Number of distinct labels.
+    
+    with_min: bool
+        Whether to compute `min_counts`.
+
+    Returns
+    -------
+    max_counts: array of shape (n_neighbors, n_rows)
+        Entry [j, i] is the count of the most frequent label among the first j+1 neighbors of point i.
+
+    min_counts: array of shape (n_neighbors, n_rows)
+        Same for the least frequent label (None if `with_min` is False).
+    
+    label_stats: array
+        Per-label counts (see _cumulative_label_counts()) with few labels, or the most frequent labels 
+        (see _sparse_label_counts()) with many. Pass to _top_labels_at().
+    """
+    if n_labels > _MAX_DENSE_COUNT_LABELS:
+        return _sparse_label_counts(nbr_codes, n_labels, with_min=with_min)
+    label_counts = _cumulative_label_counts(nbr_codes, n_labels)
+    return (label_counts.max(axis=1), label_counts.min(axis=1) if with_min else None, label_counts)
+
+
+def _top_labels_at(label_stats, nbr_ndces, row_ndces):
+    """
+    Code of the most frequent label (lowest code on ties) among the first nbr_ndces[m]+1 neighbors of point 
+    row_ndces[m], for each m. `label_stats` is as returned by _label_count_extremes().
+    """
+    if label_stats.ndim == 3:
+        return np.argmax(label_stats[nbr_ndces, :, row_ndces], axis=1)
+    return label_stats[nbr_ndces, row_ndces]
+
+
+def _cumulative_label_counts(nbr_codes, n_labels):
+    """
+    Counts of each label among the first j+1 neighbors of each point.
+    
+    Parameters
+    ----------
+    nbr_codes: array of shape (n_rows, n_neighbors)
+        Integer label codes of the ordered nearest neighbors of each query point.
+
+    n_labels: int
+        Number of distinct labels.
+
+    Returns
+    -------
+    array of shape (n_neighbors, n_labels, n_rows)
+        Entry [j, l, i] is the number of neighbors of point i with label l, among its first j+1 neighbors.
+    """
+    # Laid out so that each step of the running sum is one contiguous vector add over all (label, row) pairs.
+    label_counts = (nbr_codes.T[:, None, :] == np.arange(n_labels)[None, :, None]).astype(
+        np.min_scalar_type(nbr_codes.shape[1]))
+    for j in range(1, nbr_codes.shape[1]):
+        np.add(label_counts[j-1], label_counts[j], out=label_counts[j])
+    return label_counts
+
+
+def _sparse_label_counts(nbr_codes, n_labels, with_min=True):
+    """
+    Same as _label_count_extremes(), for many labels: memory and time do not depend on n_labels. 
+    
+    Each point's labels are first renumbered, in increasing order of code, among only those occurring in its 
+    neighbor list (at most n_neighbors of them). Running counts are then updated one neighbor at a time by 
+    scattering into a (n_rows, n_neighbors) table. The least frequent label count is tracked through the number 
+    of labels at each count level, which starts with all `n_labels` labels at count 0.
+    
+    Returns
+    -------
+    max_counts, min_counts: arrays of shape (n_neighbors, n_rows)
+        As in _label_count_extremes().
+    
+    top_labels: array of shape (n_neighbors, n_rows)
+        Entry [j, i] is the code of the most frequent label (lowest code on ties) among the first j+1 neighbors of point i.
+    """
+    num_rows, num_nbrs = nbr_codes.shape
+    order = np.argsort(nbr_codes, axis=1, kind='stable')
+    sorted_codes = np.take_along_axis(nbr_codes, order, axis=1)
+    is_new = np.ones(sorted_codes.shape, dtype=bool)
+    is_new[:, 1:] = sorted_codes[:, 1:] != sorted_codes[:, :-1]
+    local_sorted = np.cumsum(is_new, axis=1) - 1
+    local_codes = np.zeros(nbr_codes.shape, dtype=np.int64)
+    np.put_along_axis(local_codes, order, local_sorted, axis=1)
+    local_to_code = np.zeros(nbr_codes.shape, dtype=np.int64)
+    local_to_code[np.nonzero(is_new)[0], local_sorted[is_new]] = sorted_codes[is_new]
+
+    count_dtype = np.min_scalar_type(num_nbrs)
+    row_offsets = np.arange(num_rows)*num_nbrs
+    counts = np.zeros(num_rows*num_nbrs, dtype=count_dtype)
+    max_counts = np.zeros((num_nbrs, num_rows), dtype=count_dtype)
+    top_local = np.zeros((num_nbrs, num_rows), dtype=np.int64)
+    cur_max = np.zeros(num_rows, dtype=count_dtype)
+    cur_top = np.zeros(num_rows, dtype=np.int64)
+    min_counts = np.zeros((num_nbrs, num_rows), dtype=count_dtype) if with_min else None
+    # With more labels than neighbors, some label is always unseen and the minimum count stays 0.
+    track_min = with_min and (n_labels <= num_nbrs)
+    if track_min:
+        level_offsets = np.arange(num_rows)*(num_nbrs + 2)
+        num_at_level = np.zeros(num_rows*(num_nbrs + 2), dtype=np.int64)
+        num_at_level[level_offsets] = n_labels
+        cur_min = np.zeros(num_rows, dtype=count_dtype)
+    local_codes = np.ascontiguousarray(local_codes.T)
+    for j in range(num_nbrs):
+        count_ndces = row_offsets + local_codes[j]
+        new_counts = counts[count_ndces] + 1
+        counts[count_ndces] = new_counts
+        cur_top = np.where(
+            new_counts > cur_max, local_codes[j], 
+            np.where(new_counts == cur_max, np.minimum(cur_top, local_codes[j]), cur_top))
+        np.maximum(cur_max, new_counts, out=cur_max)
+        max_counts[j] = cur_max
+        top_local[j] = cur_top
+        if track_min:
+            level_ndces = level_offsets + new_counts
+            num_at_level[level_ndces - 1] -= 1
+            num_at_level[level_ndces] += 1
+            cur_min += (new_counts - 1 == cur_min) & (num_at_level[level_ndces - 1] == 0)
+            min_counts[j] = cur_min
+    top_labels = np.take_along_axis(local_to_code, top_local.T, axis=1).T
+    return (max_counts, min_counts, top_labels)
+
+
+def _admissible_counts(thresholds, n_labels):
+    """
+    Smallest label count among the first j+1 neighbors whose bias exceeds `thresholds[j]`; j+2 if there is none. 
+    
+    Comparing integer counts against these is equivalent, bit for bit, to comparing the floating-point biases 
+    (count/(j+1) - 1/n_labels) against the thresholds, as aknn() does.
+    """
+    rngarr = np.arange(len(thresholds))+1
+    counts = np.clip(np.floor((thresholds + 1.0/n_labels)*rngarr) - 1, 0, rngarr + 1).astype(np.int64)
+    # The estimate is within a couple of counts of the exact value; step up to it.
+    for _ in range(4):
+        counts += ~(counts/rngarr - 1.0/n_labels > thresholds) & (counts <= rngarr)
+    return counts
+
+
+def _emp_margin_table(num_nbrs, n_labels):
+    """
+    Entry [j, c] is the empirical margin term (j+1)*bias^2 of a label with count c among the first j+1 neighbors, 
+    computed exactly as aknn() does.
+    """
+    rngarr = (np.arange(num_nbrs)+1)[:, None]
+    biases = np.arange(num_nbrs + 1)/rngarr - 1.0/n_labels
+    return rngarr*biases*biases
+
+
+def _critical_margin_table(num_nbrs, n_labels):
+    """
+    Entry [j, c] is the confidence parameter A at which a label with count c among the first j+1 neighbors 
+    stops being admissible: the label is admissible exactly when A is below it. 
+    
+    This accounts for floating-point rounding of the thresholds A/sqrt(j+1) used by predict_nn_rule().
+    """
+    rngarr = (np.arange(num_nbrs)+1)[:, None]
+    sqrt_rngarr = np.sqrt(np.arange(num_nbrs)+1)[:, None]
+    biases = np.arange(num_nbrs + 1)/rngarr - 1.0/n_labels
+    critical = biases*sqrt_rngarr
+    # Within a few ulps of the exact value; step to the smallest A whose threshold reaches the bias.
+    for _ in range(4):
+        below = np.nextafter(critical, -np.inf)
+        critical = np.where(below/sqrt_rngarr >= biases, below, critical)
+        critical = np.where(critical/sqrt_rngarr < biases, np.nextafter(critical, np.inf), critical)
+    return critical
+
+
+def aknn(nbrs_arr, labels, thresholds, distinct_labels=None):
     """
     Apply AKNN rule for a query point, given its list of nearest neighbors.
     
@@ -115,6 +922,10 @@ def aknn(nbrs_arr, labels, thresholds, distinct_labels=['A','B','C','D','E','F',
     
     thresholds: array of shape (n_neighbors)
         Bias thresholds at different neighborhood sizes.
+    
+    distinct_labels: array of shape (n_labels), optional
+        Labels to consider, in order of tie-breaking preference. Defaults to the sorted distinct values of `labels`; 
+        pass them in when calling repeatedly, to avoid recomputing them.
 
     Returns
     -------
@@ -130,21 +941,119 @@ def aknn(nbrs_arr, labels, thresholds, distinct_labels=['A','B','C','D','E','F',
     emp_margin: float
         Empirical "advantage" of the point, as specific by the AKNN paper.
     """
-    query_nbrs = labels[nbrs_arr]
-    mtr = np.stack([query_nbrs == i for i in distinct_labels])
+    labels = np.asarray(labels)
+    distinct_labels = np.unique(labels) if distinct_labels is None else np.asarray(distinct_labels)
+    (fracs_labels, biases, emp_margin) = _label_fraction_curves(nbrs_arr, labels, distinct_labels)
+    (pred_label, first_admissible_ndx) = _stop_on_curves(biases, thresholds, distinct_labels)
+    return (pred_label, first_admissible_ndx, fracs_labels, emp_margin)
+
+
+def _label_fraction_curves(nbrs_arr, labels, distinct_labels):
+    """
+    Fraction of each of `distinct_labels` among the first j+1 neighbors `nbrs_arr` for all j, those fractions' biases 
+    (fractions minus 1/n_labels), each of shape (n_labels, n_neighbors), and the empirical margin of the point.
+    """
+    nbr_codes = _encode_with(labels[nbrs_arr], distinct_labels)
     rngarr = np.arange(len(nbrs_arr))+1
-    fracs_labels = np.cumsum(mtr, axis=1)/rngarr
+    fracs_labels = _cumulative_label_counts(nbr_codes[None, :], len(distinct_labels))[:, :, 0].T/rngarr
     biases = fracs_labels - 1.0/len(distinct_labels)
     emp_margin = np.max(rngarr*biases*biases)
+    return fracs_labels, biases, emp_margin
+
+
+def _stop_on_curves(biases, thresholds, distinct_labels):
+    """AKNN prediction ('?' if it abstains) and first admissible index, from a point's label bias curves."""
     numlabels_predicted = np.sum(biases > thresholds, axis=0)
     admissible_ndces = np.where(numlabels_predicted > 0)[0]
-    first_admissible_ndx = admissible_ndces[0] if len(admissible_ndces) > 0 else len(nbrs_arr)
+    first_admissible_ndx = admissible_ndces[0] if len(admissible_ndces) > 0 else biases.shape[1]
     # Break any ties between labels at stopping radius, by taking the most biased label
-    pred_label = '?' if first_admissible_ndx == len(nbrs_arr) else distinct_labels[np.argmax(biases[:, first_admissible_ndx])]
-    return (pred_label, first_admissible_ndx, fracs_labels, emp_margin)
+    pred_label = '?' if first_admissible_ndx == biases.shape[1] else distinct_labels[np.argmax(biases[:, first_admissible_ndx])]
+    return pred_label, first_admissible_ndx
+
+
+class PointExplainer(object):
+    """
+    Explanations of AKNN's decision on individual points of one dataset, for interactive use.
+    
+    A point's label fraction curves do not depend on the confidence parameter, so they are computed once per point 
+    and kept in a bounded LRU cache; explaining the same point at another margin only recomputes the thresholds and 
+    the stopping index. Full explanations are also cached, by (point, margin). Cached arrays are read-only.
+    
+    Parameters
+    ----------
+    nbr_list_sorted: array of shape (n_samples, n_neighbors), or RaggedNeighbors
+        Ordered nearest neighbors of each point. With RaggedNeighbors, a point's curves end at its stored 
+        number of neighbors, margins above its max_margin raise ValueError, and empirical margins are NaN, 
+        as they need the full lists.
+    
+    labels: array of shape (n_samples)
+        Dataset labels.
+    
+    distinct_labels: array of shape (n_labels), optional
+        Labels in order of tie-breaking preference, as in aknn().
+    
+    cache_size: int
+        Maximum number of points whose curves are cached, and of (point, margin) explanations.
+    """
+
+    def __init__(self, nbr_list_sorted, labels, distinct_labels=None, cache_size=1024):
+        self.nbr_list_sorted = nbr_list_sorted
+        self.labels = np.asarray(labels)
+        self.distinct_labels = np.unique(self.labels) if distinct_labels is None else np.asarray(distinct_labels)
+        self.curves = functools.lru_cache(maxsize=cache_size)(self._curves)
+        self.explain = functools.lru_cache(maxsize=cache_size)(self._explain)
 
+    def cache_nbytes(self):
+        """
+        Upper bound on the bytes held by the caches: each cached point holds its fracs_labels and biases, 
+        and each cached explanation its thresholds and fracs_labels (which may have left the point cache).
+        """
+        row_bytes = 8*self.nbr_list_sorted.shape[1]
+        num_labels = len(self.distinct_labels)
+        return (self.curves.cache_info().currsize*2*num_labels + self.explain.cache_info().currsize*(num_labels + 1))*row_bytes
 
-def knn_rule(nbr_list_sorted, labels, k=10):
+    def _curves(self, point_idx):
+        """(fracs_labels, biases, emp_margin) of a point, as in aknn(). Cached; see curves()."""
+        if isinstance(self.nbr_list_sorted, RaggedNeighbors):
+            nbrs_arr = self.nbr_list_sorted.row(point_idx)
+        else:
+            nbrs_arr = self.nbr_list_sorted[point_idx]
+        (fracs_labels, biases, emp_margin) = _label_fraction_curves(np.asarray(nbrs_arr), self.labels, self.distinct_labels)
+        if isinstance(self.nbr_list_sorted, RaggedNeighbors):
+            emp_margin = np.nan
+        fracs_labels.flags.writeable = False
+        biases.flags.writeable = False
+        return fracs_labels, biases, emp_margin
+
+    def _explain(self, point_idx, margin):
+        """
+        AKNN's decision on point `point_idx` at confidence parameter `margin`. Cached; see explain().
+
+        Returns
+        -------
+        dict with keys
+            'distinct_labels': labels indexing the rows of the curves.
+            'fracs_labels': array of shape (n_labels, n_neighbors), fraction of each label in balls of 
+            different neighborhood sizes.
+            'thresholds': array of shape (n_neighbors), bias thresholds margin/sqrt(k) at each size k.
+            'first_admissible_ndx': n-1, where AKNN chooses neighborhood size n (the length of the curves where 
+            it abstains).
+            'pred_label': AKNN label prediction ('?' where it abstains).
+            'emp_margin': empirical "advantage" of the point (NaN with RaggedNeighbors).
+        """
+        if isinstance(self.nbr_list_sorted, RaggedNeighbors):
+            self.nbr_list_sorted.check_margin(margin)
+        (fracs_labels, biases, emp_margin) = self.curves(point_idx)
+        thresholds = margin/np.sqrt(np.arange(fracs_labels.shape[1])+1)
+        thresholds.flags.writeable = False
+        (pred_label, first_admissible_ndx) = _stop_on_curves(biases, thresholds, self.distinct_labels)
+        return {
+            'distinct_labels': self.distinct_labels, 'fracs_labels': fracs_labels, 'thresholds': thresholds, 
+            'first_admissible_ndx': first_admissible_ndx, 'pred_label': pred_label, 'emp_margin': emp_margin
+        }
+
+
+def knn_rule(nbr_list_sorted, labels, k=10, chunk_size=256):
     """
     For benchmarking: given matrix of ordered nearest neighbors for each point, returns kNN rule's label predictions.
     
@@ -152,49 +1061,1178 @@ def knn_rule(nbr_list_sorted, labels, k=10):
     ----------
     nbr_list_sorted: array of shape (n_samples, n_neighbors)
         Indices of the `n_neighbors` nearest neighbors in the dataset, for each data point.
+    
+    labels: array of shape (n_samples)
+        Dataset labels.
+    
+    k: int, or list of ints
+        Neighborhood size(s). Several values are evaluated in a single pass over the running label counts, 
+        with ties broken towards the lowest label for every k.
+    
+    chunk_size: int
+        Number of rows of `nbr_list_sorted` evaluated together.
 
     Returns
     -------
-    array of shape (n_samples)
+    array of shape (n_samples), or (len(k), n_samples) if `k` is a list
         Predictions of the k-NN rule for each data point.
     """
-    toret = []
-    for i in range(nbr_list_sorted.shape[0]):
-        uq = np.unique(labels[nbr_list_sorted[i,:k]], return_counts=True)
-        toret.append(uq[0][np.argmax(uq[1])])
-    return np.array(toret)
+    ks = np.atleast_1d(k)
+    (distinct_labels, label_codes) = _encode_labels(labels)
+    num_points = nbr_list_sorted.shape[0]
+    pred_codes = np.zeros((len(ks), num_points), dtype=np.int64)
+    for start in range(0, num_points, chunk_size):
+        nbr_codes = label_codes[np.asarray(nbr_list_sorted[start:start + chunk_size, :np.max(ks)])]
+        (_, _, label_stats) = _label_count_extremes(nbr_codes, len(distinct_labels), with_min=False)
+        row_ndces = np.arange(nbr_codes.shape[0])
+        for i in range(len(ks)):
+            pred_codes[i, start:start + chunk_size] = _top_labels_at(
+                label_stats, np.full(len(row_ndces), ks[i] - 1), row_ndces)
+    toret = distinct_labels[pred_codes]
+    return toret if np.ndim(k) > 0 else toret[0]
+
+
+class CriticalMarginIndex(object):
+    """
+    AKNN predictions for every value of the confidence parameter A, from one pass over the neighbor matrix.
+    
+    A point is admissible at neighbor index j when sqrt(j+1)*(max label bias) exceeds A, so its adaptive 
+    neighborhood for A is the first index at which the running maximum of that quantity exceeds A. 
+    For each point we store only the breakpoints of this running maximum (its index, value and most biased label), 
+    in a CSR-style layout. Querying any A is then a search over each point's breakpoints.
+    
+    Query results match predict_nn_rule() exactly, including on floating-point ties.
+    """
+
+    def __init__(self, distinct_labels, num_nbrs, indptr, bp_ndces, bp_margins, bp_labels, emp_margins):
+        self.distinct_labels = distinct_labels
+        self.num_nbrs = int(num_nbrs)
+        self.indptr = indptr
+        self.bp_ndces = bp_ndces
+        self.bp_margins = bp_margins
+        self.bp_labels = bp_labels
+        self.emp_margins = emp_margins
+
+    @classmethod
+    def build(cls, nbr_list_sorted, labels, chunk_size=256):
+        """
+        Build the index from a matrix of ordered nearest neighbors.
+        
+        Parameters
+        ----------
+        nbr_list_sorted: array of shape (n_samples, n_neighbors)
+            Indices of the `n_neighbors` nearest neighbors in the dataset, for each data point.
+
+        labels: array of shape (n_samples)
+            Dataset labels.
+        
+        chunk_size: int
+            Number of rows of `nbr_list_sorted` processed together.
+
+        Returns
+        -------
+        CriticalMarginIndex
+        """
+        (distinct_labels, label_codes) = _encode_labels(labels)
+        num_points, num_nbrs = nbr_list_sorted.shape
+        margin_table = _emp_margin_table(num_nbrs, len(distinct_labels))
+        critical_table = _critical_margin_table(num_nbrs, len(distinct_labels))
+        table_offsets = (np.arange(num_nbrs)*(num_nbrs + 1))[:, None]
+        bp_counts, bp_ndces, bp_margins, bp_labels = [], [], [], []
+        emp_margins = np.zeros(num_points)
+        for start in range(0, num_points, chunk_size):
+            nbr_codes = label_codes[np.asarray(nbr_list_sorted[start:start + chunk_size])]
+            (max_counts, min_counts, label_stats) = _label_count_extremes(nbr_codes, len(distinct_labels))
+            emp_margins[start:start + chunk_size] = np.maximum(
+                margin_table.take(table_offsets + max_counts).max(axis=0), 
+                margin_table.take(table_offsets + min_counts).max(axis=0)
+            )
+            running_max = np.maximum.accumulate(critical_table.take(table_offsets + max_counts), axis=0).T
+            is_breakpoint = np.ones(running_max.shape, dtype=bool)
+            is_breakpoint[:, 1:] = running_max[:, 1:] > running_max[:, :-1]
+            (row_ndces, col_ndces) = np.nonzero(is_breakpoint)
+            bp_counts.append(is_breakpoint.sum(axis=1))
+            bp_ndces.append(col_ndces)
+            bp_margins.append(running_max[row_ndces, col_ndces])
+            bp_labels.append(_top_labels_at(label_stats, col_ndces, row_ndces))
+        indptr = np.zeros(num_points + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(bp_counts), out=indptr[1:])
+        return cls(
+            distinct_labels, num_nbrs, indptr, 
+            np.concatenate(bp_ndces).astype(np.min_scalar_type(num_nbrs)), 
+            np.concatenate(bp_margins), 
+            np.concatenate(bp_labels).astype(label_codes.dtype), 
+            emp_margins
+        )
+
+    def query(self, margin=1.0):
+        """
+        AKNN label predictions and adaptive neighborhood sizes for confidence parameter `margin`.
+
+        Returns
+        -------
+        Same as predict_nn_rule(): (pred_labels, adaptive_ks, emp_margins).
+        """
+        # Breakpoint values increase within each point, so those at most `margin` form a prefix of it.
+        num_passed = np.add.reduceat((self.bp_margins <= margin).astype(np.int64), self.indptr[:-1])
+        is_decided = num_passed < np.diff(self.indptr)
+        bp_chosen = np.minimum(self.indptr[:-1] + num_passed, len(self.bp_ndces) - 1)
+        adaptive_ks = np.where(is_decided, self.bp_ndces[bp_chosen].astype(np.int64), self.num_nbrs) + 1
+        pred_labels = _decode_labels(np.where(is_decided, self.bp_labels[bp_chosen].astype(np.int64), -1), self.distinct_labels)
+        return pred_labels, adaptive_ks, self.emp_margins
+
+    def save(self, path):
+        """Write the index to an uncompressed .npz file."""
+        np.savez(
+            path, distinct_labels=_savable_labels(self.distinct_labels), num_nbrs=self.num_nbrs, indptr=self.indptr, 
+            bp_ndces=self.bp_ndces, bp_margins=self.bp_margins, bp_labels=self.bp_labels, emp_margins=self.emp_margins
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by save()."""
+        with np.load(path) as arrs:
+            return cls(
+                arrs['distinct_labels'], arrs['num_nbrs'], arrs['indptr'], 
+                arrs['bp_ndces'], arrs['bp_margins'], arrs['bp_labels'], arrs['emp_margins']
+            )
+
+
+class RaggedNeighbors(object):
+    """
+    Compact storage of ordered neighbor lists, each truncated at the largest adaptive neighborhood size 
+    it can need for confidence parameters up to `max_margin`.
+    
+    Adaptive neighborhoods only grow with the confidence parameter, so a point that is admissible at `max_margin` 
+    after k neighbors is admissible within its first k neighbors at any smaller margin; only points on which AKNN 
+    abstains at `max_margin` keep all their neighbors. The lists are stored in a CSR-style layout, with indices 
+    in the smallest sufficient integer dtype, and can be memory-mapped from disk (see save() and load()).
+    
+    Rows are read by slicing, which returns them as a dense block padded to the longest row in it 
+    (by repeating each row's last neighbor). Padding is never reached by AKNN at margins up to `max_margin`, 
+    so predict_nn_rule() and _predict_codes() accept this in place of the full neighbor matrix.
+    """
+
+    def __init__(self, indptr, indices, num_nbrs, max_margin):
+        self.indptr = indptr
+        self.indices = indices
+        self.num_nbrs = int(num_nbrs)
+        self.max_margin = float(max_margin)
+
+    @property
+    def shape(self):
+        """Shape (n_samples, n_neighbors) of the full neighbor matrix."""
+        return (len(self.indptr) - 1, self.num_nbrs)
+
+    @classmethod
+    def from_dense(cls, nbr_list_sorted, labels, max_margin=9.5, chunk_size=256):
+        """
+        Truncate a matrix of ordered nearest neighbors.
+        
+        Parameters
+        ----------
+        nbr_list_sorted: array of shape (n_samples, n_neighbors)
+            Indices of the `n_neighbors` nearest neighbors in the dataset, for each data point.
+
+        labels: array of shape (n_samples)
+            Dataset labels.
+        
+        max_margin: float
+            Largest confidence parameter at which the stored lists will be evaluated.
 
+        Returns
+        -------
+        RaggedNeighbors
+        """
+        (distinct_labels, label_codes) = _encode_labels(labels)
+        num_points, num_nbrs = nbr_list_sorted.shape
+        (_, adaptive_ks, _) = _predict_codes(
+            nbr_list_sorted, label_codes, len(distinct_labels), max_margin, chunk_size=chunk_size, 
+            compute_margins=False)
+        row_lengths = np.minimum(adaptive_ks, num_nbrs)
+        indptr = np.zeros(num_points + 1, dtype=np.int64)
+        np.cumsum(row_lengths, out=indptr[1:])
+        indices = np.zeros(indptr[-1], dtype=np.min_scalar_type(max(len(labels) - 1, 0)))
+        for start in range(0, num_points, chunk_size):
+            nbr_block = np.asarray(nbr_list_sorted[start:start + chunk_size])
+            indices[indptr[start]:indptr[start + len(nbr_block)]] = nbr_block[
+                np.arange(num_nbrs) < row_lengths[start:start + len(nbr_block), None]]
+        return cls(indptr, indices, num_nbrs, max_margin)
 
-def _calc_nbrs_exact(raw_data, k=1000, brute_force=False, use_nndescent=False, query_is_ref=True):
+    def row(self, i):
+        """Stored neighbors of point `i`, nearest first."""
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def row_range(self, start, stop):
+        """The lists of points `start` to `stop` - 1, as RaggedNeighbors sharing this one's storage."""
+        return RaggedNeighbors(self.indptr[start:stop + 1], self.indices, self.num_nbrs, self.max_margin)
+
+    def __getitem__(self, rows):
+        """Stored neighbor lists of a slice of points, as a padded block of shape (n_rows, longest stored list)."""
+        if not isinstance(rows, slice) or rows.step not in [None, 1]:
+            raise TypeError("RaggedNeighbors only supports contiguous row slices.")
+        (start, stop, _) = rows.indices(self.shape[0])
+        row_starts = self.indptr[start:stop]
+        row_ends = self.indptr[start + 1:stop + 1]
+        row_lengths = row_ends - row_starts
+        if len(row_lengths) == 0:
+            return np.zeros((0, 0), dtype=self.indices.dtype)
+        col_ndces = np.minimum(np.arange(np.max(row_lengths)), row_lengths[:, None] - 1)
+        return np.asarray(self.indices[row_starts[0]:row_ends[-1]])[(row_starts - row_starts[0])[:, None] + col_ndces]
+
+    def check_margin(self, margin):
+        """Raise ValueError if the lists are too short for exact AKNN results at `margin`."""
+        if margin > self.max_margin:
+            raise ValueError("Neighbor lists were truncated for margins up to {}, not {}.".format(self.max_margin, margin))
+
+    def save(self, path):
+        """
+        Write the lists to directory `path`, as .npy files which load() can memory-map. 
+        
+        The files are written to a temporary directory which then replaces `path`, so files already memory-mapped 
+        by other processes are never rewritten in place. If several processes save the same lists concurrently, 
+        the first to finish is kept.
+        """
+        path = path.rstrip(os.sep)
+        tmp_path = _tmp_path(path)
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, 'indptr.npy'), self.indptr)
+        np.save(os.path.join(tmp_path, 'indices.npy'), self.indices)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'num_nbrs': self.num_nbrs, 'max_margin': self.max_margin}, f)
+        _replace_dir(tmp_path, path, 'meta.json')
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Read lists written by save(), memory-mapped by default."""
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(
+            np.load(os.path.join(path, 'indptr.npy'), mmap_mode=mmap_mode), 
+            np.load(os.path.join(path, 'indices.npy'), mmap_mode=mmap_mode), 
+            meta['num_nbrs'], meta['max_margin']
+        )
+
+
+class IncrementalAKNN(object):
     """
-    Calculate list of `k` exact Euclidean nearest neighbors for each point.
+    AKNN predictions on a growing labeled dataset, in which each point is classified using its other neighbors.
+    
+    Keeps the data, each point's exact `k` nearest neighbors with their distances, and the predictions. 
+    add_points() inserts new labeled points without rebuilding the neighbor graph: it searches the new points' 
+    neighbors, splices each new point into the lists of the existing points it is closer to than their current 
+    k-th neighbor, and re-evaluates AKNN only on the lists that changed. Results match a full rebuild with 
+    _calc_nbrs_blocked() and predict_nn_rule(), up to floating-point ties in distance.
     
     Parameters
     ----------
-    raw_data: array of shape (n_samples, n_features)
-        Input dataset.
+    data: array or scipy sparse matrix of shape (n_samples, n_features)
+        Initial labeled dataset, with n_samples > k.
+    
+    labels: array of shape (n_samples)
+        Initial dataset labels.
+    
+    k: int
+        Number of neighbors kept per point.
+    
+    margin: float
+        The confidence parameter "A" from the AKNN paper.
+    
+    compute_margins: bool
+        Whether to compute empirical margins. See predict_nn_rule().
+    
+    metric: string
+        'euclidean' or 'cosine'.
+    
+    n_jobs, max_memory_mb: int
+        Number of threads and approximate memory budget for neighbor search (see _calc_nbrs_blocked()).
+    """
+
+    def __init__(
+        self, data, labels, k=100, margin=1.0, compute_margins=True, metric='euclidean', n_jobs=1, max_memory_mb=512
+    ):
+        if data.shape[0] <= k:
+            raise ValueError("Need more than k={} points to start from; got {}.".format(k, data.shape[0]))
+        self.k = k
+        self.margin = margin
+        self.compute_margins = compute_margins
+        self.metric = metric
+        self.n_jobs = n_jobs
+        self.max_memory_mb = max_memory_mb
+        self.data = data.tocsr() if scipy.sparse.issparse(data) else np.asarray(data)
+        self.labels = np.asarray(labels)
+        self.row_norms = _row_norms(self.data, metric)
+        self.nbr_list_sorted = _calc_nbrs_blocked(
+            self.data, k=k, metric=metric, n_jobs=n_jobs, max_memory_mb=max_memory_mb, ref_norms=self.row_norms)
+        self.nbr_dists = self._paired_dists(np.arange(self.data.shape[0]), self.nbr_list_sorted)
+        (self.distinct_labels, self.label_codes) = _encode_labels(self.labels)
+        num_points = self.data.shape[0]
+        self.pred_codes = np.zeros(num_points, dtype=np.int64)
+        self.adaptive_ks = np.zeros(num_points, dtype=np.int64)
+        self.emp_margins = np.full(num_points, np.nan)
+        self._update_predictions(np.arange(num_points))
+
+    def predictions(self):
+        """Current predictions on all points, as from predict_nn_rule(): (pred_labels, adaptive_ks, emp_margins)."""
+        return _decode_labels(self.pred_codes, self.distinct_labels), self.adaptive_ks, self.emp_margins
+
+    def add_points(self, new_data, new_labels):
+        """
+        Insert labeled points, updating neighbor lists and predictions.
+        
+        Parameters
+        ----------
+        new_data: array or scipy sparse matrix of shape (n_new, n_features)
+            New points, which get indices n_samples, ..., n_samples + n_new - 1.
+        
+        new_labels: array of shape (n_new)
+            Their labels. A label not seen before changes the baseline 1/n_labels of every point's bias, 
+            so then all predictions are recomputed.
+
+        Returns
+        -------
+        updated_rows: array
+            Indices of the points whose neighbor lists changed (including all new points), 
+            on which predictions were recomputed.
+        """
+        num_old = self.data.shape[0]
+        if scipy.sparse.issparse(self.data):
+            new_data = scipy.sparse.csr_matrix(new_data)
+        else:
+            new_data = np.asarray(new_data)
+        new_labels = np.asarray(new_labels)
+        num_new = new_data.shape[0]
+        new_norms = _row_norms(new_data, self.metric)
+        changed_rows = self._splice_new_points(new_data, new_norms)
+        # The new points' own lists are searched among all points, excluding each point itself.
+        if scipy.sparse.issparse(self.data):
+            self.data = scipy.sparse.vstack([self.data, new_data], format='csr')
+        else:
+            self.data = np.concatenate([self.data, new_data])
+        self.row_norms = np.concatenate([self.row_norms, new_norms])
+        new_ndces = num_old + np.arange(num_new)
+        new_nbrs = _drop_self_nbrs(_calc_nbrs_blocked(
+            self.data, k=self.k + 1, query_data=new_data, metric=self.metric, n_jobs=self.n_jobs, 
+            max_memory_mb=self.max_memory_mb, ref_norms=self.row_norms), new_ndces)
+        self.nbr_list_sorted = np.concatenate([self.nbr_list_sorted, new_nbrs])
+        self.nbr_dists = np.concatenate([self.nbr_dists, self._paired_dists(new_ndces, new_nbrs)])
+        self.labels = np.concatenate([self.labels, new_labels])
+        self.pred_codes = np.concatenate([self.pred_codes, np.zeros(num_new, dtype=np.int64)])
+        self.adaptive_ks = np.concatenate([self.adaptive_ks, np.zeros(num_new, dtype=np.int64)])
+        self.emp_margins = np.concatenate([self.emp_margins, np.full(num_new, np.nan)])
+        new_codes = _encode_with(new_labels, self.distinct_labels)
+        if np.any(new_codes < 0):
+            (self.distinct_labels, self.label_codes) = _encode_labels(self.labels)
+            updated_rows = np.arange(self.data.shape[0])
+        else:
+            self.label_codes = np.concatenate([self.label_codes, new_codes.astype(self.label_codes.dtype)])
+            updated_rows = np.concatenate([changed_rows, new_ndces])
+        self._update_predictions(updated_rows)
+        return updated_rows
+
+    def _splice_new_points(self, new_data, new_norms):
+        """
+        Insert new points (not yet appended to self.data) into the neighbor lists of existing points they are 
+        closer to than those points' current k-th neighbors. Returns the indices of the lists that changed.
+        """
+        num_old = self.data.shape[0]
+        num_new = new_data.shape[0]
+        new_ndces = num_old + np.arange(num_new)
+        new_rows_t = new_data.T
+        # Each tile holds float64 distances and int64 indices for (existing rows) x (new points + current neighbors).
+        tile_size = int(max(1, self.max_memory_mb*(2**20)/(16*(num_new + self.k))))
+        changed_rows = []
+        for start in range(0, num_old, tile_size):
+            tile_ndces = np.arange(start, min(start + tile_size, num_old))
+            dots = _tile_rows(self.data, tile_ndces).dot(new_rows_t)
+            dists = _dists_from_dots(
+                dots.toarray() if scipy.sparse.issparse(dots) else np.asarray(dots, dtype=np.float64), 
+                self.row_norms[tile_ndces][:, None], new_norms[None, :], self.metric)
+            # Ties with current neighbors go to them, as they have lower indices.
+            is_closer = dists < self.nbr_dists[tile_ndces, -1][:, None]
+            hit_ndces = np.nonzero(is_closer.any(axis=1))[0]
+            if len(hit_ndces) == 0:
+                continue
+            hit_rows = tile_ndces[hit_ndces]
+            merged_dists = np.concatenate(
+                [self.nbr_dists[hit_rows], np.where(is_closer[hit_ndces], dists[hit_ndces], np.inf)], axis=1)
+            merged_ndces = np.concatenate(
+                [self.nbr_list_sorted[hit_rows], np.broadcast_to(new_ndces, (len(hit_rows), num_new))], axis=1)
+            # Current lists are ordered by (distance, index) and new points come after them in index order, 
+            # so a stable sort by distance keeps that order.
+            order = np.argsort(merged_dists, axis=1, kind='stable')[:, :self.k]
+            self.nbr_dists[hit_rows] = np.take_along_axis(merged_dists, order, axis=1)
+            self.nbr_list_sorted[hit_rows] = np.take_along_axis(merged_ndces, order, axis=1)
+            changed_rows.append(hit_rows)
+        return np.concatenate(changed_rows) if len(changed_rows) > 0 else np.zeros(0, dtype=np.int64)
+
+    def _paired_dists(self, row_ndces, nbr_list_sorted):
+        """Distance from each point `row_ndces[i]` to each of its neighbors `nbr_list_sorted[i]`."""
+        num_nbrs = nbr_list_sorted.shape[1]
+        dists = np.zeros(nbr_list_sorted.shape)
+        # Rows per chunk, so that the gathered pairs of feature vectors take about max_memory_mb.
+        chunk_size = int(max(1, self.max_memory_mb*(2**20)/(16*num_nbrs*self.data.shape[1])))
+        for start in range(0, len(row_ndces), chunk_size):
+            chunk_rows = row_ndces[start:start + chunk_size]
+            chunk_nbrs = nbr_list_sorted[start:start + chunk_size]
+            query_rows = _take_rows(self.data, np.repeat(chunk_rows, num_nbrs))
+            nbr_rows = _take_rows(self.data, chunk_nbrs.ravel())
+            if scipy.sparse.issparse(self.data):
+                dots = np.asarray(query_rows.multiply(nbr_rows).sum(axis=1), dtype=np.float64).ravel()
+            else:
+                dots = np.einsum('ij,ij->i', query_rows, nbr_rows, dtype=np.float64)
+            dists[start:start + chunk_size] = _dists_from_dots(
+                dots.reshape(chunk_nbrs.shape), self.row_norms[chunk_rows][:, None], self.row_norms[chunk_nbrs], self.metric)
+        return dists
+
+    def _update_predictions(self, row_ndces):
+        (self.pred_codes[row_ndces], self.adaptive_ks[row_ndces], self.emp_margins[row_ndces]) = _predict_codes(
+            self.nbr_list_sorted[row_ndces], self.label_codes, len(self.distinct_labels), self.margin, 
+            compute_margins=self.compute_margins)
+
+
+# =======================================================
+# ================ Out-of-core prediction ================
+# =======================================================
+
+def predict_streaming(
+    ref_data, labels, out_dir, query_data=None, k=100, margin=1.0, compute_margins=True, block_size=4096, 
+    metric='euclidean', n_jobs=1, max_memory_mb=512
+):
+    """
+    AKNN predictions for datasets larger than memory. Query points are read in blocks; each block's neighbors 
+    are searched by streaming over the reference data in tiles (see _calc_nbrs_blocked()), AKNN is applied, 
+    and the results are written to disk before the next block is read. Peak memory is bounded by 
+    `block_size`, `k` and `max_memory_mb`, not by the number of points. Inputs given as files are memory-mapped; 
+    a sparse .npz file is first converted to memory-mappable files next to it (see load_npz_mmap()).
+    
+    Results go to .npy files in `out_dir`, with progress recorded after each block. If interrupted, calling 
+    again with the same arguments resumes after the last completed block. Results are only resumed if the data, 
+    labels and settings are the same, as recorded by their fingerprints.
+    
+    Parameters
+    ----------
+    ref_data: array, scipy sparse matrix, or path to a .npy file (memory-mapped) or a scipy sparse .npz file
+        Reference dataset, of shape (n_samples, n_features).
+    
+    labels: array of shape (n_samples)
+        Reference dataset labels.
+    
+    out_dir: string
+        Directory for the results (see load_streaming_results()).
+    
+    query_data: optional, array, scipy sparse matrix, path as for `ref_data`, or list of such paths
+        Query points; a list of paths is read as consecutive chunks of rows. If None, classifies each 
+        reference point using its other neighbors.
+    
+    block_size: int
+        Number of query points processed at once.
+    
+    n_jobs, max_memory_mb: int
+        Number of threads and approximate memory budget for neighbor search.
+
+    Returns
+    -------
+    Same as load_streaming_results(out_dir).
+    """
+    ref_data = _open_rows(ref_data)
+    query_is_ref = query_data is None
+    query_chunks = [ref_data] if query_is_ref else [_open_rows(chunk) for chunk in (
+        query_data if isinstance(query_data, (list, tuple)) else [query_data])]
+    num_queries = sum(chunk.shape[0] for chunk in query_chunks)
+    (distinct_labels, label_codes) = _encode_labels(labels)
+    settings = {
+        'num_queries': int(num_queries), 'num_ref': int(ref_data.shape[0]), 'k': int(k), 'margin': float(margin), 
+        'metric': metric, 'compute_margins': bool(compute_margins), 'block_size': int(block_size), 
+        'ref_fingerprint': data_fingerprint(ref_data), 
+        'query_fingerprints': None if query_is_ref else [data_fingerprint(chunk) for chunk in query_chunks], 
+        'labels_hash': hashlib.sha1(
+            np.ascontiguousarray(label_codes).view(np.uint8).tobytes() + str(list(distinct_labels)).encode()
+        ).hexdigest()
+    }
+    (outputs, rows_done) = _open_streaming_outputs(out_dir, settings, distinct_labels)
+    ref_norms = _row_norms(ref_data, metric)
+    query_start = 0
+    for chunk in query_chunks:
+        for block_start in range(0, chunk.shape[0], block_size):
+            row_ndces = query_start + np.arange(block_start, min(block_start + block_size, chunk.shape[0]))
+            if row_ndces[-1] < rows_done:
+                continue
+            block = _tile_rows(chunk, np.arange(block_start, block_start + len(row_ndces)))
+            if query_is_ref:
+                nbr_list_sorted = _drop_self_nbrs(_calc_nbrs_blocked(
+                    ref_data, k=k + 1, query_data=block, metric=metric, n_jobs=n_jobs, max_memory_mb=max_memory_mb, 
+                    ref_norms=ref_norms
+                ), row_ndces)
+            else:
+                nbr_list_sorted = _calc_nbrs_blocked(
+                    ref_data, k=k, query_data=block, metric=metric, n_jobs=n_jobs, max_memory_mb=max_memory_mb, 
+                    ref_norms=ref_norms)
+            block_results = _predict_codes(
+                nbr_list_sorted, label_codes, len(distinct_labels), margin, compute_margins=compute_margins)
+            for (output, block_result) in zip(outputs, block_results):
+                output[row_ndces] = block_result
+                output.flush()
+            _write_progress(out_dir, settings, row_ndces[-1] + 1)
+        query_start += chunk.shape[0]
+    del outputs
+    return load_streaming_results(out_dir)
+
+
+def load_streaming_results(out_dir):
+    """
+    Results written by predict_streaming(), as from predict_nn_rule(): (pred_labels, adaptive_ks, emp_margins). 
+    Adaptive ks and margins are memory-mapped. Points not yet processed have adaptive k 0.
+    """
+    distinct_labels = np.load(os.path.join(out_dir, 'distinct_labels.npy'))
+    pred_codes = np.load(os.path.join(out_dir, 'pred_codes.npy'), mmap_mode='r')
+    return (
+        _decode_labels(np.asarray(pred_codes), distinct_labels), 
+        np.load(os.path.join(out_dir, 'adaptive_ks.npy'), mmap_mode='r'), 
+        np.load(os.path.join(out_dir, 'emp_margins.npy'), mmap_mode='r')
+    )
+
+
+def _open_rows(source):
+    """
+    A dense array, sparse CSR matrix, or path to one (memory-mapped; see load_npz_mmap() for .npz files), 
+    as something row-sliceable.
+    """
+    if isinstance(source, str):
+        if source.endswith('.npz'):
+            return load_npz_mmap(source, sparse_format='csr')
+        return np.load(source, mmap_mode='r')
+    return source.tocsr() if scipy.sparse.issparse(source) else source
+
+
+def load_npz_mmap(npz_path, sparse_format='csr'):
+    """
+    A scipy sparse .npz matrix as CSR or CSC (`sparse_format`), with its arrays memory-mapped. 
+    
+    The .npz format cannot be memory-mapped, so on first use the matrix is loaded once and its arrays are written 
+    as .npy files to the directory <npz_path without .npz>_<sparse_format>, which later calls map directly. 
+    Concurrent first calls (e.g. from several processes) are safe: each writes a temporary directory, and 
+    the first to finish is kept.
+    """
+    mmap_dir = '{}_{}'.format(npz_path[:-len('.npz')], sparse_format)
+    names = ['data', 'indices', 'indptr', 'shape']
+    if not os.path.exists(os.path.join(mmap_dir, 'shape.npy')):
+        mat = scipy.sparse.load_npz(npz_path).asformat(sparse_format)
+        mat.sort_indices()
+        tmp_dir = _tmp_path(mmap_dir)
+        os.makedirs(tmp_dir, exist_ok=True)
+        for (name, arr) in zip(names, [mat.data, mat.indices, mat.indptr, np.array(mat.shape)]):
+            np.save(os.path.join(tmp_dir, name + '.npy'), arr)
+        del mat
+        _replace_dir(tmp_dir, mmap_dir, 'shape.npy', keep_existing=True)
+    (data, indices, indptr, shape) = [np.load(os.path.join(mmap_dir, name + '.npy'), mmap_mode='r') for name in names]
+    matrix_class = scipy.sparse.csr_matrix if sparse_format == 'csr' else scipy.sparse.csc_matrix
+    return matrix_class((data, indices, indptr), shape=tuple(shape), copy=False)
+
+
+def _open_streaming_outputs(out_dir, settings, distinct_labels):
+    """
+    Memory-mapped output arrays (pred_codes, adaptive_ks, emp_margins) in `out_dir`, and the number of rows 
+    already completed. Existing outputs are reused only if they were written with the same settings.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    progress_path = os.path.join(out_dir, 'progress.json')
+    rows_done = 0
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress['settings'] == settings:
+            rows_done = progress['rows_done']
+    num_queries = settings['num_queries']
+    outputs = []
+    for (name, dtype, fill_value) in [('pred_codes', np.int64, -1), ('adaptive_ks', np.int64, 0), ('emp_margins', np.float64, np.nan)]:
+        path = os.path.join(out_dir, name + '.npy')
+        if rows_done > 0:
+            outputs.append(np.lib.format.open_memmap(path, mode='r+'))
+        else:
+            output = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(num_queries,))
+            output[:] = fill_value
+            outputs.append(output)
+    if rows_done == 0:
+        np.save(os.path.join(out_dir, 'distinct_labels.npy'), _savable_labels(distinct_labels))
+        _write_progress(out_dir, settings, 0)
+    return outputs, rows_done
+
+
+def _write_progress(out_dir, settings, rows_done):
+    """Record that the first `rows_done` query points are complete. The file is replaced atomically."""
+    progress_path = os.path.join(out_dir, 'progress.json')
+    tmp_path = _tmp_path(progress_path)
+    with open(tmp_path, 'w') as f:
+        json.dump({ 'settings': settings, 'rows_done': int(rows_done) }, f)
+    os.replace(tmp_path, progress_path)
+
+
+def _savable_labels(distinct_labels):
+    """Labels as an array np.save can write without pickling (object arrays, e.g. from pandas, become strings)."""
+    return distinct_labels.astype(str) if distinct_labels.dtype == object else distinct_labels
+
+
+# =======================================================
+# =============== Neighbor search backends ===============
+# =======================================================
+
+class NeighborBackend(object):
+    """
+    A method of computing ordered nearest neighbor lists. Subclasses implement search(); 
+    `is_exact` is False for approximate methods, whose results should be checked with neighbor_recall().
+    """
+    name = None
+    is_exact = True
+
+    def supports(self, raw_data, metric='euclidean'):
+        """Whether this backend can search `raw_data` under `metric`."""
+        return metric in ['euclidean', 'cosine']
+
+    def search(self, raw_data, k, query_data=None, query_is_ref=True, metric='euclidean', n_jobs=1, max_memory_mb=512):
+        """
+        Indices of the `k` nearest points of `raw_data` to each query point, nearest first.
+        
+        Parameters
+        ----------
+        raw_data: array or scipy sparse matrix of shape (n_samples, n_features)
+            Reference dataset.
+        
+        query_data: array or scipy sparse matrix of shape (n_queries, n_features), optional
+            Query points. If None, the query points are `raw_data` themselves.
+        
+        query_is_ref: bool
+            If `query_data` is None, whether to exclude each point from its own neighbor list.
+
+        Returns
+        -------
+        nbr_list_sorted: array of shape (n_queries, k)
+        """
+        raise NotImplementedError
+
+
+class TreeBackend(NeighborBackend):
+    """Exact search with a space-partitioning tree (sklearn's NearestNeighbors). Dense data only."""
+    name = 'tree'
+
+    def supports(self, raw_data, metric='euclidean'):
+        return (not scipy.sparse.issparse(raw_data)) and metric in ['euclidean', 'cosine']
+
+    def search(self, raw_data, k, query_data=None, query_is_ref=True, metric='euclidean', n_jobs=1, max_memory_mb=512):
+        exclude_self = (query_data is None) and query_is_ref
+        index = NearestNeighbors(n_neighbors=k, metric=metric, n_jobs=n_jobs).fit(raw_data)
+        if not exclude_self:
+            return index.kneighbors(raw_data if query_data is None else query_data, return_distance=False)
+        nbr_list_sorted = index.kneighbors(raw_data, n_neighbors=k+1, return_distance=False)
+        return _drop_self_nbrs(nbr_list_sorted, np.arange(nbr_list_sorted.shape[0]))
+
+
+class BruteForceBackend(NeighborBackend):
+    """Exact blocked brute-force search (see _calc_nbrs_blocked()). Dense or sparse data."""
+    name = 'brute'
+
+    def search(self, raw_data, k, query_data=None, query_is_ref=True, metric='euclidean', n_jobs=1, max_memory_mb=512):
+        return _calc_nbrs_blocked(
+            raw_data, k=k, query_data=query_data, query_is_ref=query_is_ref, n_jobs=n_jobs, 
+            max_memory_mb=max_memory_mb, metric=metric)
+
+
+class NNDescentBackend(NeighborBackend):
+    """Approximate search by nearest neighbor descent (pynndescent). Dense or sparse data."""
+    name = 'nndescent'
+    is_exact = False
+
+    def search(self, raw_data, k, query_data=None, query_is_ref=True, metric='euclidean', n_jobs=1, max_memory_mb=512):
+        # Imported here, as importing pynndescent compiles its kernels, which takes several seconds.
+        import pynndescent
+        exclude_self = (query_data is None) and query_is_ref
+        index = pynndescent.NNDescent(
+            raw_data, n_neighbors=min(k + 1 if exclude_self else k, raw_data.shape[0] - 1), metric=metric, 
+            n_jobs=n_jobs, random_state=0)
+        if query_data is not None:
+            return index.query(query_data, k=k)[0]
+        (nbr_list_sorted, _) = index.neighbor_graph
+        if not exclude_self:
+            return nbr_list_sorted
+        return _drop_self_nbrs(nbr_list_sorted, np.arange(nbr_list_sorted.shape[0]))
+
+
+NEIGHBOR_BACKENDS = { backend.name: backend for backend in [TreeBackend(), BruteForceBackend(), NNDescentBackend()] }
+
+
+def _drop_self_nbrs(nbr_list_sorted, row_ndces):
+    """
+    Remove each point `row_ndces[i]` from row i of a neighbor matrix with one extra column. 
+    With duplicate points, a point may not be listed first in its own row, or at all; then the last entry is dropped.
+    """
+    is_self = (nbr_list_sorted == row_ndces[:, None])
+    is_self[~is_self.any(axis=1), -1] = True
+    return nbr_list_sorted[~is_self].reshape(len(row_ndces), nbr_list_sorted.shape[1] - 1)
+
+
+def calc_nbrs(
+    raw_data, k=1000, backend='auto', query_data=None, query_is_ref=True, metric='euclidean', target_recall=0.99, 
+    recall_sample_size=256, n_jobs=1, max_memory_mb=512, cache_dir=None, metrics=NULL_METRICS
+):
+    """
+    Nearest neighbor lists from a chosen backend (see NEIGHBOR_BACKENDS), with a report of the search.
+    
+    Parameters
+    ----------
+    raw_data: array or scipy sparse matrix of shape (n_samples, n_features)
+        Reference dataset.
+    
+    backend: string
+        'tree', 'brute', 'nndescent', or 'auto' to let select_nbr_backend() choose the fastest backend 
+        whose recall meets `target_recall`.
+    
+    query_data: array or scipy sparse matrix of shape (n_queries, n_features), optional
+        Query points. If None, the query points are `raw_data` themselves.
+    
+    recall_sample_size: int
+        Number of query points checked against exact neighbors, when the backend is approximate (0 to skip the check).
+    
+    cache_dir: string, optional
+        Directory of cached neighbor matrices (see _calc_nbrs_exact()). Only used when `query_data` is None.
+    
+    metrics: MetricsSink
+        Receives a neighbor search event with the contents of `search_info` (see MetricsSink).
+
+    Returns
+    -------
+    nbr_list_sorted: array of shape (n_queries, k)
+        Indices of the `k` nearest neighbors of each query point, nearest first.
+    
+    search_info: dict
+        'backend': name of the backend used; 'time': seconds spent searching; 'recall': recall@k on a sample 
+        of query points (see neighbor_recall()), or None for exact backends.
+    """
+    start_time = time.perf_counter()
+    if backend == 'auto':
+        (backend, _) = select_nbr_backend(
+            raw_data, k, target_recall=target_recall, query_is_ref=query_is_ref, metric=metric, n_jobs=n_jobs)
+    nbr_backend = NEIGHBOR_BACKENDS[backend]
+    if not nbr_backend.supports(raw_data, metric=metric):
+        raise ValueError("Backend '{}' does not support this data with metric '{}'.".format(backend, metric))
+    if (cache_dir is not None) and (query_data is None):
+        cache_key = '_'.join([data_fingerprint(raw_data), metric, backend, 'self' if query_is_ref else 'all'])
+        nbr_list_sorted = _load_cached_nbrs(cache_dir, cache_key, k)
+        if nbr_list_sorted is None:
+            nbr_list_sorted = nbr_backend.search(
+                raw_data, k, query_is_ref=query_is_ref, metric=metric, n_jobs=n_jobs, max_memory_mb=max_memory_mb)
+            _save_cached_nbrs(cache_dir, cache_key, nbr_list_sorted)
+    else:
+        nbr_list_sorted = nbr_backend.search(
+            raw_data, k, query_data=query_data, query_is_ref=query_is_ref, metric=metric, n_jobs=n_jobs, 
+            max_memory_mb=max_memory_mb)
+    search_info = { 'backend': backend, 'time': time.perf_counter() - start_time, 'recall': None }
+    if (not nbr_backend.is_exact) and (recall_sample_size > 0):
+        search_info['recall'] = neighbor_recall(
+            raw_data, nbr_list_sorted, query_data=query_data, query_is_ref=query_is_ref, metric=metric, 
+            sample_size=recall_sample_size)
+    _emit_stage(metrics, 'neighbor_search', start_time, len(nbr_list_sorted), backend=backend, k=k, recall=search_info['recall'])
+    return nbr_list_sorted, search_info
+
+
+def neighbor_recall(raw_data, nbr_list_sorted, query_data=None, query_is_ref=True, metric='euclidean', sample_size=256, seed=0):
+    """
+    Recall@k of (possibly approximate) neighbor lists: the average fraction of each query point's exact `k` nearest 
+    neighbors that its list contains, over a random sample of `sample_size` query points. 
+    Exact neighbors are found by brute force; with ties in distance, even exact lists can score slightly below 1.
+    """
+    num_queries, k = nbr_list_sorted.shape
+    rng = np.random.RandomState(seed)
+    sample_ndces = np.sort(rng.choice(num_queries, size=min(sample_size, num_queries), replace=False))
+    exclude_self = (query_data is None) and query_is_ref
+    sample_queries = _take_rows(raw_data if query_data is None else query_data, sample_ndces)
+    exact_nbrs = _calc_nbrs_blocked(
+        raw_data, k=k + 1 if exclude_self else k, query_data=sample_queries, metric=metric)
+    if exclude_self:
+        exact_nbrs = _drop_self_nbrs(exact_nbrs, sample_ndces)
+    approx_nbrs = np.asarray(nbr_list_sorted[sample_ndces])
+    num_found = [len(np.intersect1d(approx_nbrs[i], exact_nbrs[i])) for i in range(len(sample_ndces))]
+    return float(np.mean(num_found))/k
+
+
+def select_nbr_backend(
+    raw_data, k, target_recall=0.99, query_is_ref=True, metric='euclidean', trial_size=1000, n_jobs=1, seed=0
+):
+    """
+    Choose the backend expected to be fastest at finding `k` neighbors of each point of `raw_data`, 
+    among those that meet `target_recall` (exact backends always do).
+    
+    Each supported backend is timed on random subsets of the data of sizes m and 2m (with m at least `trial_size` 
+    and 4k, unless the data are smaller). Its running time on all n points is extrapolated as t(2m) * (n/2m)^a, 
+    with the growth exponent a = log2(t(2m)/t(m)) clipped to [1, 2]. The recall of approximate backends is measured 
+    on the larger trial subset.
+
+    Returns
+    -------
+    backend: string
+        Name of the chosen backend.
+    
+    trials: dict
+        For each backend tried, a dict with its 'est_time' (extrapolated seconds) and 'recall' (None if exact).
+    """
+    num_points = raw_data.shape[0]
+    trial_points = min(max(trial_size, 4*k), num_points//2)
+    if trial_points <= k + 1:
+        # Too few points for a meaningful trial, and too few for the choice to matter.
+        return 'brute', {}
+    rng = np.random.RandomState(seed)
+    trial_ndces = np.sort(rng.choice(num_points, size=2*trial_points, replace=False))
+    trial_data = [_take_rows(raw_data, trial_ndces[::2]), _take_rows(raw_data, trial_ndces)]
+    trials = {}
+    for (name, nbr_backend) in NEIGHBOR_BACKENDS.items():
+        if not nbr_backend.supports(raw_data, metric=metric):
+            continue
+        trial_times = []
+        for data_subset in trial_data:
+            itime = time.time()
+            nbr_list_sorted = nbr_backend.search(data_subset, k, query_is_ref=query_is_ref, metric=metric, n_jobs=n_jobs)
+            trial_times.append(time.time() - itime)
+        growth_exponent = np.clip(np.log2(max(trial_times[1], 1e-6)/max(trial_times[0], 1e-6)), 1, 2)
+        trials[name] = {
+            'est_time': trial_times[1]*((num_points/(2.0*trial_points))**growth_exponent), 
+            'recall': None if nbr_backend.is_exact else neighbor_recall(
+                trial_data[1], nbr_list_sorted, query_is_ref=query_is_ref, metric=metric, seed=seed)
+        }
+    eligible = [name for name in trials if (trials[name]['recall'] is None) or (trials[name]['recall'] >= target_recall)]
+    return min(eligible, key=lambda name: trials[name]['est_time']), trials
+
+
+def _take_rows(data, row_ndces):
+    """Rows `row_ndces` of a dense array or scipy sparse matrix (converted to CSR)."""
+    if scipy.sparse.issparse(data):
+        return data.tocsr()[row_ndces]
+    return np.asarray(data[row_ndces])
+
+
+def _calc_nbrs_exact(
+    raw_data, k=1000, brute_force=False, use_nndescent=False, query_is_ref=True, cache_dir=None, 
+    n_jobs=1, max_memory_mb=512, metric='euclidean'
+):
+    """
+    Calculate list of `k` exact nearest neighbors for each point.
+    
+    Parameters
+    ----------
+    raw_data: array or scipy sparse matrix of shape (n_samples, n_features)
+        Input dataset. Sparse matrices are searched with blocked brute force, without being densified.
+    
+    brute_force: bool
+        Whether to use blocked brute-force search (see _calc_nbrs_blocked()) instead of a space-partitioning tree.
+    
+    use_nndescent: bool
+        Whether to use approximate search by nearest neighbor descent instead. See calc_nbrs() for 
+        choosing among backends by measured recall.
+    
+    n_jobs, max_memory_mb: int
+        Number of threads and approximate memory budget for brute-force search.
+    
+    cache_dir: string, optional
+        Directory of cached neighbor matrices, keyed by a fingerprint of the data and the search settings. 
+        Cached matrices are loaded memory-mapped; a request for fewer neighbors than a cached matrix holds 
+        is served from its leading columns. Results computed here are added to the cache.
+    
+    metric: string
+        'euclidean' or 'cosine'.
 
     Returns
     -------
     nbr_list_sorted: array of shape (n_samples, n_neighbors)
         Indices of the `n_neighbors` nearest neighbors in the dataset, for each data point.
     """
-    if use_nndescent:
-        index = pynndescent.NNDescent(raw_data, n_neighbors=k)
-        indices, distances = index.neighbor_graph
-        if query_is_ref:
-            return indices[:, 1:]
+    backend = 'nndescent' if use_nndescent else ('brute' if brute_force or scipy.sparse.issparse(raw_data) else 'tree')
+    (nbr_list_sorted, _) = calc_nbrs(
+        raw_data, k=k, backend=backend, query_is_ref=query_is_ref, metric=metric, recall_sample_size=0, 
+        n_jobs=n_jobs, max_memory_mb=max_memory_mb, cache_dir=cache_dir)
+    return nbr_list_sorted
+
+
+def _calc_nbrs_blocked(
+    raw_data, k=1000, query_data=None, query_is_ref=True, n_jobs=1, max_memory_mb=512, metric='euclidean', 
+    ref_norms=None
+):
+    """
+    Exact nearest neighbors by blocked brute-force search, without materializing all pairwise distances.
+    
+    Query points are processed in tiles, in parallel threads. Each query tile is compared against successive 
+    tiles of the reference data, keeping a running top-`k` per query point by partial selection. 
+    Distances are computed from dot products and precomputed row norms, so scipy sparse (CSR) data 
+    is handled natively: only one (query tile) x (reference tile) block is ever dense.
+    
+    Parameters
+    ----------
+    raw_data: array or scipy sparse matrix of shape (n_samples, n_features)
+        Reference dataset.
+    
+    query_data: array or scipy sparse matrix of shape (n_queries, n_features), optional
+        Query points. If None, the query points are `raw_data` themselves.
+    
+    query_is_ref: bool
+        If `query_data` is None, whether to exclude each point from its own neighbor list.
+    
+    n_jobs: int
+        Number of threads over which query tiles are distributed.
+    
+    max_memory_mb: int
+        Approximate budget for the memory held at once besides the result: the data, distance and running top-`k` 
+        tiles, with their temporaries, over all threads. A single query row and reference row are always processed, 
+        however large.
+    
+    metric: string
+        'euclidean' or 'cosine'.
+    
+    ref_norms: array of shape (n_samples), optional
+        _row_norms(raw_data, metric), if already computed; saves a pass over `raw_data` when it is searched repeatedly.
+
+    Returns
+    -------
+    nbr_list_sorted: array of shape (n_queries, k)
+        Indices of the `k` nearest reference points of each query point, nearest first (ties by lower index).
+    """
+    if metric not in ['euclidean', 'cosine']:
+        raise ValueError("Unsupported metric for blocked search: {}".format(metric))
+    exclude_self = (query_data is None) and query_is_ref
+    if query_data is None:
+        query_data = raw_data
+    if scipy.sparse.issparse(raw_data):
+        raw_data = raw_data.tocsr()
+    if scipy.sparse.issparse(query_data):
+        query_data = query_data.tocsr()
+    num_ref = raw_data.shape[0]
+    num_kept = min(k + 1 if exclude_self else k, num_ref)
+    if ref_norms is None:
+        ref_norms = _row_norms(raw_data, metric)
+    query_norms = ref_norms if query_data is raw_data else _row_norms(query_data, metric)
+    # Per thread, each query row holds its data, and its running top-k distances and indices with the temporaries of 
+    # selecting from them (40 bytes per kept neighbor); query tiles take up to half the budget. Each reference row 
+    # holds its data, and per query row a distance (8 bytes, 20 from a sparse product), buffer entries for it and its 
+    # index, and a selection index (24 bytes).
+    tile_bytes = max_memory_mb*(2**20)/max(n_jobs, 1)
+    query_row_bytes = _cum_row_bytes(query_data)
+    ref_row_bytes = query_row_bytes if query_data is raw_data else _cum_row_bytes(raw_data)
+    bytes_per_dist = 44 if scipy.sparse.issparse(query_data) or scipy.sparse.issparse(raw_data) else 32
+    query_bounds = _tile_bounds(query_row_bytes, 40*num_kept, tile_bytes/2, max_rows=1024)
+    nbr_list_sorted = np.zeros((query_data.shape[0], num_kept), dtype=np.int64)
+
+    def search_tile(query_bound):
+        query_ndces = np.arange(*query_bound)
+        query_tile = _tile_rows(query_data, query_ndces)
+        query_tile_bytes = 40*num_kept*len(query_ndces) + query_row_bytes[query_bound[1]] - query_row_bytes[query_bound[0]]
+        ref_bounds = _tile_bounds(ref_row_bytes, bytes_per_dist*len(query_ndces), tile_bytes - query_tile_bytes)
+        # The running top-k lists are followed by the distances to the current reference tile.
+        buffer_width = num_kept + max(end - start for (start, end) in ref_bounds)
+        best_dists = np.empty((len(query_ndces), buffer_width))
+        best_ndces = np.empty((len(query_ndces), buffer_width), dtype=np.int64)
+        num_best = 0
+        for ref_bound in ref_bounds:
+            ref_ndces = np.arange(*ref_bound)
+            dots = query_tile.dot(_tile_rows(raw_data, ref_ndces).T)
+            dists = _dists_from_dots(
+                dots.toarray() if scipy.sparse.issparse(dots) else np.asarray(dots), 
+                query_norms[query_ndces][:, None], ref_norms[ref_ndces][None, :], metric)
+            if exclude_self:
+                # Make sure each point comes first in its own list, so that it is the one dropped.
+                is_self = (query_ndces >= ref_ndces[0]) & (query_ndces <= ref_ndces[-1])
+                dists[is_self, query_ndces[is_self] - ref_ndces[0]] = -np.inf
+            best_dists[:, num_best:num_best + len(ref_ndces)] = dists
+            best_ndces[:, num_best:num_best + len(ref_ndces)] = ref_ndces
+            num_best += len(ref_ndces)
+            del dots, dists
+            if num_best > num_kept:
+                top = np.argpartition(best_dists[:, :num_best], num_kept - 1, axis=1)[:, :num_kept]
+                best_dists[:, :num_kept] = np.take_along_axis(best_dists, top, axis=1)
+                best_ndces[:, :num_kept] = np.take_along_axis(best_ndces, top, axis=1)
+                num_best = num_kept
+                del top
+        (best_dists, best_ndces) = (best_dists[:, :num_kept], best_ndces[:, :num_kept])
+        # Order each list by distance, breaking ties by index.
+        order = np.argsort(best_ndces, axis=1)
+        order = np.take_along_axis(order, np.argsort(np.take_along_axis(best_dists, order, axis=1), axis=1, kind='stable'), axis=1)
+        nbr_list_sorted[query_ndces] = np.take_along_axis(best_ndces, order, axis=1)
+
+    if n_jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(search_tile, query_bounds))
+    else:
+        for query_bound in query_bounds:
+            search_tile(query_bound)
+    return nbr_list_sorted[:, 1:] if exclude_self else nbr_list_sorted
+
+
+def _row_norms(data, metric):
+    """
+    Per-row quantities from which _dists_from_dots() computes distances: squared norms for 'euclidean', 
+    inverse norms for 'cosine'.
+    """
+    sqnorms = _row_sqnorms(data)
+    return _safe_inverse(np.sqrt(sqnorms)) if metric == 'cosine' else sqnorms
+
+
+def _dists_from_dots(dots, query_norms, ref_norms, metric):
+    """
+    Distances (squared for 'euclidean') from dot products `dots` and broadcastable row norms from _row_norms(). 
+    Overwrites `dots`.
+    """
+    if metric == 'cosine':
+        # Cosine distance is 1 - <x, y>/(|x||y|); rows of norm zero are at distance 1 from everything, as in sklearn.
+        dots *= -query_norms
+        dots *= ref_norms
+        dots += 1
+    else:
+        dots *= -2
+        dots += query_norms
+        dots += ref_norms
+    return dots
+
+
+def _row_sqnorms(data, max_block_mb=64):
+    """
+    Squared Euclidean norm of each row of a dense array or sparse matrix, as float64. Computed over blocks of rows 
+    of about `max_block_mb`, so that memory-mapped data is never copied into memory whole.
+    """
+    if scipy.sparse.issparse(data):
+        data = data.tocsr()
+    sqnorms = np.zeros(data.shape[0])
+    for (start, end) in _tile_bounds(_cum_row_bytes(data), 0, max_block_mb*(2**20)):
+        if scipy.sparse.issparse(data):
+            (lo, hi) = (data.indptr[start], data.indptr[end])
+            vals = np.square(data.data[lo:hi], dtype=np.float64)
+            # Sums over the stored values of each nonempty row; empty rows keep a norm of 0.
+            offsets = data.indptr[start:end] - lo
+            is_nonempty = offsets < data.indptr[start+1:end+1] - lo
+            sqnorms[start:end][is_nonempty] = np.add.reduceat(vals, offsets[is_nonempty])
         else:
-            return indices
-    if brute_force:
-        a = sklearn.metrics.pairwise_distances(raw_data)
-        nbr_list_sorted = np.argsort(a, axis=1)
-        if query_is_ref:
-            nbr_list_sorted = nbr_list_sorted[:, 1:]
-        return nbr_list_sorted[:, :k]
+            block = _tile_rows(data, np.arange(start, end))
+            sqnorms[start:end] = np.einsum('ij,ij->i', block, block)
+    return sqnorms
+
+
+def _safe_inverse(arr):
+    """Elementwise 1/arr, with 0 where arr is 0."""
+    inv = np.zeros(arr.shape)
+    np.divide(1.0, arr, out=inv, where=(arr != 0))
+    return inv
+
+
+def _tile_rows(data, row_ndces):
+    """
+    Rows of `data` at a contiguous range of indices `row_ndces`, in float64: 
+    a dense array for dense data, or a CSR matrix for sparse data.
+    """
+    rows = data[row_ndces[0]:row_ndces[-1] + 1]
+    if scipy.sparse.issparse(rows):
+        return rows.astype(np.float64, copy=False)
+    return np.asarray(rows, dtype=np.float64)
+
+
+def _cum_row_bytes(data):
+    """
+    Cumulative bytes of the first 0, 1, ..., n_samples rows of `data` as copied by _tile_rows(): 
+    float64 values for dense data; for CSR data, the sliced values, indices and row pointers, and the values in float64.
+    """
+    if scipy.sparse.issparse(data):
+        return 20*data.indptr.astype(np.int64) + 8*np.arange(data.shape[0] + 1)
+    return 8*data.shape[1]*np.arange(data.shape[0] + 1)
+
+
+def _tile_bounds(cum_row_bytes, bytes_per_row, max_bytes, max_rows=None):
+    """
+    Bounds (start, end) of consecutive tiles of rows, each of at most `max_rows` rows and `max_bytes`, counting 
+    the row data from `cum_row_bytes` (see _cum_row_bytes()) and `bytes_per_row` more for each row. 
+    Each tile has at least one row.
+    """
+    num_rows = len(cum_row_bytes) - 1
+    cum_bytes = cum_row_bytes + bytes_per_row*np.arange(num_rows + 1)
+    max_rows = num_rows if max_rows is None else max_rows
+    bounds = []
+    start = 0
+    while start < num_rows:
+        end = np.searchsorted(cum_bytes, cum_bytes[start] + max_bytes, side='right') - 1
+        end = int(min(max(end, start + 1), start + max_rows, num_rows))
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+# =======================================================
+# ================= Neighbor matrix cache ================
+# =======================================================
+
+def data_fingerprint(raw_data):
+    """
+    Hex digest identifying the contents of a dense array or scipy sparse matrix (values, shape and dtype).
+    """
+    hasher = hashlib.sha1()
+    if scipy.sparse.issparse(raw_data):
+        raw_data = raw_data.tocsr()
+        raw_data.sort_indices()
+        arrs = [raw_data.data, raw_data.indices, raw_data.indptr]
+        hasher.update(b'csr')
     else:
-        distances, indices = NearestNeighbors(n_neighbors=k+1).fit(raw_data).kneighbors(raw_data)
-        if query_is_ref:
-            return indices[:, 1:]
+        arrs = [np.asarray(raw_data)]
+    hasher.update(str((raw_data.shape, raw_data.dtype.str)).encode())
+    for arr in arrs:
+        hasher.update(np.ascontiguousarray(arr).view(np.uint8))
+    return hasher.hexdigest()
+
+
+def _load_cached_nbrs(cache_dir, cache_key, k):
+    """
+    Memory-mapped leading `k` columns of the smallest cached neighbor matrix under `cache_key` with at least `k` 
+    columns, or None if there is none.
+    """
+    cached_ks = []
+    for fname in glob.glob(os.path.join(cache_dir, cache_key + '_k*.npy')):
+        k_str = os.path.basename(fname)[len(cache_key) + 2:-len('.npy')]
+        if k_str.isdigit() and int(k_str) >= k:
+            cached_ks.append(int(k_str))
+    if len(cached_ks) == 0:
+        return None
+    fname = os.path.join(cache_dir, '{}_k{}.npy'.format(cache_key, min(cached_ks)))
+    return np.load(fname, mmap_mode='r')[:, :k]
+
+
+def _save_cached_nbrs(cache_dir, cache_key, nbr_list_sorted):
+    """
+    Add a neighbor matrix to the cache. The file is written under a temporary name and then renamed, 
+    so concurrent readers never see a partial matrix.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = os.path.join(cache_dir, '{}_k{}.npy'.format(cache_key, nbr_list_sorted.shape[1]))
+    tmp_fname = _tmp_path(fname, suffix='.npy')    # np.save() would otherwise append .npy to the name.
+    np.save(tmp_fname, nbr_list_sorted)
+    os.replace(tmp_fname, fname)
+
+
+def _tmp_path(path, suffix=''):
+    """
+    Temporary path next to `path`, unique to the calling process and thread, at which to write a file or directory 
+    before it is moved to `path` with os.replace() (see _replace_dir()), so that readers never see it partly written.
+    """
+    return '{}.{}.{}.tmp{}'.format(path, os.getpid(), threading.get_ident(), suffix)
+
+
+def _replace_dir(tmp_dir, path, marker, keep_existing=False):
+    """
+    Move the completed directory `tmp_dir` to `path`, replacing any directory there unless `keep_existing` is set. 
+    Files already memory-mapped from the old directory are never rewritten in place. If another process or thread 
+    moves a directory to `path` concurrently, the first to finish is kept; a directory is complete once it has 
+    the file `marker`, written last.
+    """
+    try:
+        if keep_existing and os.path.exists(os.path.join(path, marker)):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        elif os.path.exists(path):
+            # A directory cannot be replaced by rename while it has files, so move the old one aside first.
+            old_path = tmp_dir + '.old'
+            os.replace(path, old_path)
+            os.replace(tmp_dir, path)
+            shutil.rmtree(old_path, ignore_errors=True)
         else:
-            return indices
+            os.replace(tmp_dir, path)
+    except OSError:
+        if not os.path.exists(os.path.join(path, marker)):
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,211 @@
+"""
+Benchmarks for neighbor search and AKNN prediction.
+
+Times neighbor search (_calc_nbrs_exact, per backend), predict_nn_rule and knn_rule over synthetic datasets
+that vary the number of points, dimension, sparsity, k, number of classes and margin, recording the
+peak memory allocated in each. Results are written as JSON; two result files can then be compared
+to flag regressions.
+
+Usage:
+    python aknn_bench.py run --preset quick --out results.json
+    python aknn_bench.py compare base.json results.json --tolerance 0.2
+"""
+
+import numpy as np, scipy, time, json, os, sys, platform, argparse, tracemalloc, warnings
+import scipy.sparse
+import aknn_alg
+
+
+
+# Each dataset is (name, n_samples, n_features, density, n_labels); density < 1 gives a sparse CSR matrix.
+# "images" mimics the bundled notMNIST data: 28x28 nonnegative pixel intensities, mostly zero.
+PRESETS = {
+    'quick': {
+        'datasets': [
+            ('gauss', 2000, 16, 1.0, 10),
+            ('images', 2000, 784, 0.3, 10),
+        ],
+        'search_ks': [30],
+        'backends': ['tree', 'brute'],
+        'predict_k': 200,
+        'margins': [0.5, 1.0, 4.0],
+        'knn_ks': [1, 5, 10, 30, 100],
+        'repeats': 3
+    },
+    'full': {
+        'datasets': [
+            ('gauss', 5000, 16, 1.0, 10),
+            ('gauss', 20000, 16, 1.0, 10),
+            ('gauss', 20000, 128, 1.0, 40),
+            ('images', 18724, 784, 0.3, 10),
+            ('sparse', 20000, 5000, 0.01, 100),
+        ],
+        'search_ks': [30, 1000],
+        'backends': ['tree', 'brute', 'nndescent'],
+        'predict_k': 1000,
+        'margins': [0.5, 1.0, 2.0, 4.0, 9.5],
+        'knn_ks': [1, 3, 5, 10, 30, 100, 300, 1000],
+        'repeats': 3
+    }
+}
+
+
+def make_dataset(kind, n_samples, n_features, density, n_labels, seed=0):
+    """
+    Synthetic labeled data: a mixture with one cluster per label, so that neighborhoods are label-informative.
+
+    Returns
+    -------
+    data: array or CSR matrix of shape (n_samples, n_features)
+
+    labels: array of shape (n_samples)
+    """
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(n_labels, size=n_samples)
+    centers = rng.randn(n_labels, n_features)
+    if kind == 'gauss':
+        return centers[labels] + 2.0*rng.randn(n_samples, n_features), labels.astype(str)
+    # Nonnegative data, zero outside a random set of entries which overlaps the support of the point's class.
+    is_nonzero = rng.rand(n_samples, n_features) < density
+    values = np.abs(centers[labels] + rng.randn(n_samples, n_features))
+    if kind == 'images':
+        values = np.round(255*np.minimum(values/3.0, 1.0))
+    data = scipy.sparse.csr_matrix(np.where(is_nonzero, values, 0.0))
+    return data, labels.astype(str)
+
+
+def measure(fn, repeats=3):
+    """
+    Run `fn` `repeats` times. Returns the fastest time in seconds, the peak memory (MB) allocated
+    during the first run as seen by tracemalloc, and the result of the last run.
+    """
+    tracemalloc.start()
+    result = fn()
+    peak_mb = tracemalloc.get_traced_memory()[1]/2.0**20
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeats):
+        itime = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - itime)
+    return min(times), peak_mb, result
+
+
+def run_benchmarks(preset='quick', n_jobs=1):
+    """
+    Run all benchmarks of a preset (see PRESETS).
+
+    Returns
+    -------
+    list of dicts, each with keys 'benchmark', 'params', 'time', 'peak_mb', and optionally 'recall'.
+    """
+    config = PRESETS[preset]
+    records = []
+
+    def record(benchmark, params, fn, repeats=config['repeats']):
+        (best_time, peak_mb, result) = measure(fn, repeats=repeats)
+        records.append({ 'benchmark': benchmark, 'params': params, 'time': best_time, 'peak_mb': peak_mb })
+        print('{:<16}{:<90} {:>10.4f} s{:>10.1f} MB'.format(benchmark, json.dumps(params), best_time, peak_mb))
+        return result
+
+    for (kind, n_samples, n_features, density, n_labels) in config['datasets']:
+        (data, labels) = make_dataset(kind, n_samples, n_features, density, n_labels)
+        data_params = {
+            'data': kind, 'n': n_samples, 'd': n_features, 'density': density, 'n_labels': n_labels
+        }
+        for k in config['search_ks']:
+            for backend in config['backends']:
+                if not aknn_alg.NEIGHBOR_BACKENDS[backend].supports(data):
+                    continue
+                search_fn = lambda: aknn_alg._calc_nbrs_exact(
+                    data, k=k, brute_force=(backend == 'brute'), use_nndescent=(backend == 'nndescent'), n_jobs=n_jobs)
+                if backend == 'nndescent':
+                    # Exclude one-time JIT compilation from the timings.
+                    aknn_alg._calc_nbrs_exact(data[:k + 2], k=k, use_nndescent=True)
+                params = dict(data_params, k=k, backend=backend)
+                nbr_list_sorted = record('search', params, search_fn, repeats=1)
+                if not aknn_alg.NEIGHBOR_BACKENDS[backend].is_exact:
+                    records[-1]['recall'] = aknn_alg.neighbor_recall(data, nbr_list_sorted)
+        nbr_list_sorted = aknn_alg._calc_nbrs_exact(data, k=config['predict_k'], brute_force=True, n_jobs=n_jobs)
+        predict_params = dict(data_params, k=config['predict_k'])
+        for margin in config['margins']:
+            for compute_margins in [True, False]:
+                record(
+                    'predict_nn_rule', dict(predict_params, margin=margin, compute_margins=compute_margins),
+                    lambda: aknn_alg.predict_nn_rule(
+                        nbr_list_sorted, labels, margin=margin, compute_margins=compute_margins, n_jobs=n_jobs)
+                )
+        knn_ks = [k for k in config['knn_ks'] if k <= config['predict_k']]
+        record('knn_rule', dict(predict_params, ks=knn_ks), lambda: aknn_alg.knn_rule(nbr_list_sorted, labels, k=knn_ks))
+    return records
+
+
+def environment_info():
+    return {
+        'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+        'platform': platform.platform(), 'cpu_count': os.cpu_count()
+    }
+
+
+def compare_results(base_results, new_results, tolerance=0.2, min_time=0.01):
+    """
+    Match the benchmarks of two runs by name and parameters, and flag regressions: time or peak memory
+    grown by more than a fraction `tolerance`, or recall dropped by more than 0.01.
+    Times below `min_time` seconds in both runs are too noisy to compare.
+
+    Returns
+    -------
+    list of (benchmark, params, message) for each regression.
+    """
+    def key(rec):
+        return (rec['benchmark'], json.dumps(rec['params'], sort_keys=True))
+    base_records = { key(rec): rec for rec in base_results['records'] }
+    regressions = []
+    for rec in new_results['records']:
+        base_rec = base_records.get(key(rec))
+        if base_rec is None:
+            continue
+        messages = []
+        if max(rec['time'], base_rec['time']) >= min_time and rec['time'] > (1 + tolerance)*base_rec['time']:
+            messages.append('time {:.4f} s -> {:.4f} s'.format(base_rec['time'], rec['time']))
+        if rec['peak_mb'] > (1 + tolerance)*base_rec['peak_mb'] + 1.0:
+            messages.append('peak memory {:.1f} MB -> {:.1f} MB'.format(base_rec['peak_mb'], rec['peak_mb']))
+        if rec.get('recall') is not None and base_rec.get('recall') is not None and rec['recall'] < base_rec['recall'] - 0.01:
+            messages.append('recall {:.4f} -> {:.4f}'.format(base_rec['recall'], rec['recall']))
+        if len(messages) > 0:
+            regressions.append((rec['benchmark'], rec['params'], '; '.join(messages)))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for neighbor search and AKNN prediction.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help="Run benchmarks and write results as JSON.")
+    run_parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    run_parser.add_argument('--out', default='aknn_bench_results.json')
+    run_parser.add_argument('--n_jobs', type=int, default=1)
+    compare_parser = subparsers.add_parser('compare', help="Flag regressions between two result files.")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        warnings.filterwarnings('ignore', category=UserWarning)
+        results = {
+            'preset': args.preset, 'n_jobs': args.n_jobs, 'environment': environment_info(),
+            'records': run_benchmarks(args.preset, n_jobs=args.n_jobs)
+        }
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to {}'.format(args.out))
+    else:
+        with open(args.base) as f:
+            base_results = json.load(f)
+        with open(args.new) as f:
+            new_results = json.load(f)
+        regressions = compare_results(base_results, new_results, tolerance=args.tolerance)
+        for (benchmark, params, message) in regressions:
+            print('REGRESSION {:<16}{:<90} {}'.format(benchmark, json.dumps(params), message))
+        print('{} regression(s) found.'.format(len(regressions)))
+        sys.exit(1 if len(regressions) > 0 else 0)